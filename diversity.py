@@ -0,0 +1,323 @@
+"""
+Module de calcul des indices de biodiversité à partir des effectifs par taxon.
+
+Les calculs sont vectorisés avec NumPy sur l'ensemble des unités (couches, zones...)
+à la fois : les effectifs de toutes les unités sont empilés dans un même tableau
+et agrégés par unité avec np.bincount. La comparaison entre unités (similarités)
+s'appuie sur une matrice creuse unités × taxons au format CSR.
+"""
+import os
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+
+# Seuil d'abondance séparant les taxons rares des taxons abondants pour l'estimateur ACE
+ACE_RARE_THRESHOLD = 10
+
+DIVERSITY_COLUMNS = ['nb_individuals', 'richness', 'shannon', 'simpson', 'chao1', 'ace']
+
+
+def stack_taxon_counts(taxon_counts: dict):
+    """
+    Empile les vecteurs d'effectifs de plusieurs unités dans des tableaux plats.
+
+    Args:
+        taxon_counts: Dictionnaire {unité: Series des effectifs indexée par cd_ref}
+
+    Returns:
+        Tuple (labels, unit_idx, counts) où unit_idx donne l'indice de l'unité de chaque effectif
+    """
+    labels = list(taxon_counts.keys())
+    vectors = [np.asarray(v, dtype=np.int64) for v in taxon_counts.values()]
+    if not vectors:
+        return labels, np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    lengths = np.array([len(v) for v in vectors])
+    unit_idx = np.repeat(np.arange(len(labels)), lengths)
+    counts = np.concatenate(vectors)
+
+    keep = counts > 0
+    return labels, unit_idx[keep], counts[keep]
+
+
+def _singletons_doubletons(unit_idx: np.ndarray, counts: np.ndarray, nb_units: int):
+    """Nombre de taxons observés une fois (f1) et deux fois (f2) par unité."""
+    f1 = np.bincount(unit_idx, weights=(counts == 1), minlength=nb_units)
+    f2 = np.bincount(unit_idx, weights=(counts == 2), minlength=nb_units)
+    return f1, f2
+
+
+def _chao1_f0(n: np.ndarray, f1: np.ndarray, f2: np.ndarray) -> np.ndarray:
+    """Estimation du nombre de taxons non observés (f0) selon Chao1 corrigé du biais."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correction = np.where(n > 0, (n - 1) / n, 0.0)
+        f0 = np.where(f2 > 0,
+                      correction * f1 ** 2 / (2 * f2),
+                      correction * f1 * (f1 - 1) / 2)
+    return f0
+
+
+def diversity_indices(taxon_counts: dict) -> pd.DataFrame:
+    """
+    Calcule les indices de diversité pour toutes les unités en une seule passe vectorisée.
+
+    Indices calculés : richesse observée, Shannon (logarithme népérien), Gini-Simpson (1 - somme p²),
+    Chao1 corrigé du biais et ACE (seuil de rareté ACE_RARE_THRESHOLD).
+
+    Args:
+        taxon_counts: Dictionnaire {unité: Series des effectifs indexée par cd_ref}
+
+    Returns:
+        DataFrame indexé par unité avec les colonnes DIVERSITY_COLUMNS
+    """
+    labels, unit_idx, counts = stack_taxon_counts(taxon_counts)
+    nb_units = len(labels)
+    counts_f = counts.astype(float)
+
+    n = np.bincount(unit_idx, weights=counts_f, minlength=nb_units)
+    richness = np.bincount(unit_idx, minlength=nb_units).astype(float)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = counts_f / n[unit_idx]
+        shannon = 0.0 - np.bincount(unit_idx, weights=p * np.log(p), minlength=nb_units)
+        simpson = 1 - np.bincount(unit_idx, weights=p ** 2, minlength=nb_units)
+
+        f1, f2 = _singletons_doubletons(unit_idx, counts, nb_units)
+        chao1 = richness + _chao1_f0(n, f1, f2)
+
+        # ACE : couverture estimée sur les taxons rares uniquement
+        rare = counts <= ACE_RARE_THRESHOLD
+        s_rare = np.bincount(unit_idx, weights=rare, minlength=nb_units)
+        n_rare = np.bincount(unit_idx, weights=np.where(rare, counts_f, 0), minlength=nb_units)
+        sum_ii = np.bincount(unit_idx, weights=np.where(rare, counts_f * (counts_f - 1), 0),
+                             minlength=nb_units)
+        coverage = 1 - f1 / n_rare
+        gamma2 = np.maximum(s_rare / coverage * sum_ii / (n_rare * (n_rare - 1)) - 1, 0)
+        ace = (richness - s_rare) + s_rare / coverage + f1 / coverage * gamma2
+        # Sans taxon rare, ACE vaut la richesse observée ; si tous les rares sont des singletons
+        # la couverture est nulle et l'estimateur n'est pas défini : on se rabat sur Chao1
+        ace = np.where(s_rare == 0, richness, ace)
+        ace = np.where((s_rare > 0) & (coverage <= 0), chao1, ace)
+
+    empty = n == 0
+    result = pd.DataFrame({
+        'nb_individuals': n.astype(np.int64),
+        'richness': richness.astype(np.int64),
+        'shannon': np.where(empty, np.nan, shannon),
+        'simpson': np.where(empty, np.nan, simpson),
+        'chao1': np.where(empty, np.nan, chao1),
+        'ace': np.where(empty, np.nan, ace),
+    }, index=pd.Index(labels, name='unit'))
+    return result[DIVERSITY_COLUMNS]
+
+
+def rarefaction_curves(taxon_counts: dict, nb_points: int = 40, endpoint_factor: float = 2.0) -> pd.DataFrame:
+    """
+    Calcule les courbes de raréfaction / extrapolation (basées sur les individus) pour toutes les unités.
+
+    La raréfaction utilise l'espérance de Hurlbert, l'extrapolation l'estimateur de Chao et al. (2014)
+    s'appuyant sur f0 de Chao1. Les effectifs de toutes les unités sont traités ensemble pour chaque
+    point de la courbe.
+
+    Args:
+        taxon_counts: Dictionnaire {unité: Series des effectifs indexée par cd_ref}
+        nb_points: Nombre de points de la courbe par unité
+        endpoint_factor: Taille d'échantillon maximale, en multiple de l'effectif observé
+
+    Returns:
+        DataFrame long (unit, m, richness, method) avec method parmi
+        'rarefaction', 'observed', 'extrapolation'
+    """
+    labels, unit_idx, counts = stack_taxon_counts(taxon_counts)
+    nb_units = len(labels)
+    columns = ['unit', 'm', 'richness', 'method']
+    if nb_units == 0 or len(counts) == 0:
+        return pd.DataFrame(columns=columns)
+
+    n = np.bincount(unit_idx, weights=counts, minlength=nb_units).astype(np.int64)
+    richness = np.bincount(unit_idx, minlength=nb_units).astype(float)
+    f1, f2 = _singletons_doubletons(unit_idx, counts, nb_units)
+    f0 = _chao1_f0(n.astype(float), f1, f2)
+
+    # Grille des tailles d'échantillon : nb_points valeurs entre 1 et endpoint_factor * n,
+    # en garantissant la présence de n lui-même
+    fractions = np.linspace(0, endpoint_factor, nb_points + 1)[1:]
+    grid = np.maximum(np.rint(np.outer(n, fractions)).astype(np.int64), 1)
+    grid = np.column_stack([grid, n])
+    grid.sort(axis=1)
+
+    # Table des log-factorielles partagée par toutes les unités
+    log_fact = np.concatenate([[0.0], np.cumsum(np.log(np.arange(1, n.max() + 1)))])
+
+    def log_comb(a, b):
+        return log_fact[a] - log_fact[b] - log_fact[a - b]
+
+    n_entry = n[unit_idx]
+    curve = np.empty(grid.shape, dtype=float)
+    for j in range(grid.shape[1]):
+        m = grid[:, j]
+        m_entry = np.minimum(m[unit_idx], n_entry)
+        # Probabilité qu'un taxon soit absent d'un sous-échantillon de taille m
+        absent = np.zeros(len(counts))
+        possible = n_entry - counts >= m_entry
+        absent[possible] = np.exp(log_comb(n_entry[possible] - counts[possible], m_entry[possible])
+                                  - log_comb(n_entry[possible], m_entry[possible]))
+        rarefied = np.bincount(unit_idx, weights=1 - absent, minlength=nb_units)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            base = np.where(f0 > 0, 1 - f1 / (n * f0 + f1), 1.0)
+            extrapolated = richness + f0 * (1 - base ** np.maximum(m - n, 0))
+        curve[:, j] = np.where(m <= n, rarefied, extrapolated)
+
+    method = np.where(grid < n[:, None], 'rarefaction',
+                      np.where(grid == n[:, None], 'observed', 'extrapolation'))
+    result = pd.DataFrame({
+        'unit': np.repeat(np.asarray(labels, dtype=object), grid.shape[1]),
+        'm': grid.ravel(),
+        'richness': curve.ravel(),
+        'method': method.ravel(),
+    })
+    # Les unités sans aucun individu n'ont pas de courbe
+    result = result[np.repeat(n > 0, grid.shape[1])]
+    return result.drop_duplicates(['unit', 'm']).reset_index(drop=True)[columns]
+
+
+AbundanceMatrix = namedtuple('AbundanceMatrix', ['data', 'indices', 'indptr', 'units', 'taxa'])
+AbundanceMatrix.__doc__ = """Matrice creuse unités × taxons au format CSR (lignes : unités, colonnes : cd_ref)."""
+
+
+def build_abundance_matrix(taxon_counts: dict) -> AbundanceMatrix:
+    """
+    Construit la matrice creuse des effectifs unités × taxons au format CSR.
+
+    Args:
+        taxon_counts: Dictionnaire {unité: Series des effectifs indexée par cd_ref}
+
+    Returns:
+        AbundanceMatrix dont les colonnes de chaque ligne sont triées par cd_ref
+    """
+    units = list(taxon_counts.keys())
+    series = [s[s > 0] for s in taxon_counts.values()]
+    lengths = np.array([len(s) for s in series], dtype=np.int64)
+    if lengths.sum() == 0:
+        return AbundanceMatrix(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                               np.zeros(len(units) + 1, dtype=np.int64), units, np.empty(0, dtype=np.int64))
+
+    row = np.repeat(np.arange(len(units)), lengths)
+    cd_refs = np.concatenate([np.asarray(s.index, dtype=np.int64) for s in series])
+    counts = np.concatenate([np.asarray(s, dtype=np.int64) for s in series])
+
+    taxa, col = np.unique(cd_refs, return_inverse=True)
+    order = np.lexsort((col, row))
+    indptr = np.concatenate([[0], np.cumsum(lengths)])
+    return AbundanceMatrix(counts[order], col[order], indptr, units, taxa)
+
+
+def save_abundance_matrix(matrix: AbundanceMatrix, output_folder: str, basename: str = 'speccount_matrice',
+                          taxon_table: pd.DataFrame = None, fmt: str = 'npz') -> list:
+    """
+    Sauvegarde la matrice creuse et ses tables d'index (unités et taxons).
+
+    Args:
+        matrix: Matrice à sauvegarder
+        output_folder: Dossier de sortie
+        basename: Préfixe des fichiers produits
+        taxon_table: Table TAXREF optionnelle pour ajouter nom_complet à l'index des taxons
+        fmt: 'npz' (tableaux CSR compressés) ou 'parquet' (format long unit_idx, taxon_idx, count)
+
+    Returns:
+        Liste des chemins des fichiers écrits
+    """
+    units = pd.DataFrame({'unit_idx': np.arange(len(matrix.units)), 'unit': matrix.units})
+    taxa = pd.DataFrame({'taxon_idx': np.arange(len(matrix.taxa)), 'cd_ref': matrix.taxa})
+    if taxon_table is not None and 'nom_complet' in taxon_table.columns:
+        taxa = taxa.merge(taxon_table[['cd_nom', 'nom_complet']], left_on='cd_ref', right_on='cd_nom',
+                          how='left').drop(columns='cd_nom')
+
+    if fmt == 'npz':
+        matrix_path = os.path.join(output_folder, f"{basename}.npz")
+        np.savez_compressed(matrix_path, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                            shape=np.array([len(matrix.units), len(matrix.taxa)]))
+    elif fmt == 'parquet':
+        matrix_path = os.path.join(output_folder, f"{basename}.parquet")
+        row = np.repeat(np.arange(len(matrix.units)), np.diff(matrix.indptr))
+        pd.DataFrame({'unit_idx': row, 'taxon_idx': matrix.indices, 'count': matrix.data}).to_parquet(
+            matrix_path, index=False)
+    else:
+        raise ValueError(f"Format de matrice inconnu : {fmt}")
+
+    units_path = os.path.join(output_folder, f"{basename}_unites.csv")
+    taxa_path = os.path.join(output_folder, f"{basename}_taxons.csv")
+    units.to_csv(units_path, index=False)
+    taxa.to_csv(taxa_path, index=False)
+    return [matrix_path, units_path, taxa_path]
+
+
+def pairwise_similarity(matrix: AbundanceMatrix) -> pd.DataFrame:
+    """
+    Calcule les similarités de Jaccard (présence/absence) et de Bray-Curtis (effectifs)
+    entre toutes les paires d'unités partageant au moins un taxon.
+
+    La matrice dense n'est jamais construite : pour chaque unité, les colonnes de ses taxons
+    sont lues dans la transposée creuse (CSC) et les intersections sont agrégées avec np.bincount.
+    Les paires absentes du résultat ont une similarité nulle.
+
+    Args:
+        matrix: Matrice creuse unités × taxons
+
+    Returns:
+        DataFrame (unit_a, unit_b, shared_taxa, jaccard, bray_curtis) avec unit_a < unit_b
+        dans l'ordre des unités de la matrice
+    """
+    nb_units, nb_taxa = len(matrix.units), len(matrix.taxa)
+    columns = ['unit_a', 'unit_b', 'shared_taxa', 'jaccard', 'bray_curtis']
+    if nb_units < 2 or nb_taxa == 0:
+        return pd.DataFrame(columns=columns)
+
+    row = np.repeat(np.arange(nb_units), np.diff(matrix.indptr))
+    richness = np.diff(matrix.indptr)
+    totals = np.bincount(row, weights=matrix.data, minlength=nb_units)
+
+    # Transposée CSC : pour chaque taxon, les unités (triées) qui le contiennent
+    order = np.argsort(matrix.indices, kind='stable')
+    col_units = row[order]
+    col_counts = matrix.data[order]
+    colptr = np.concatenate([[0], np.cumsum(np.bincount(matrix.indices, minlength=nb_taxa))])
+
+    units_a, units_b, shared, min_sums = [], [], [], []
+    for i in range(nb_units - 1):
+        start, end = matrix.indptr[i], matrix.indptr[i + 1]
+        taxa_i, counts_i = matrix.indices[start:end], matrix.data[start:end]
+        starts, lengths = colptr[taxa_i], colptr[taxa_i + 1] - colptr[taxa_i]
+        if lengths.sum() == 0:
+            continue
+        # Indices de toutes les entrées des colonnes des taxons de l'unité i
+        offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+        entries = offsets + np.arange(lengths.sum())
+        other = col_units[entries]
+        mins = np.minimum(col_counts[entries], np.repeat(counts_i, lengths))
+
+        keep = other > i
+        inter = np.bincount(other[keep], minlength=nb_units)
+        min_sum = np.bincount(other[keep], weights=mins[keep], minlength=nb_units)
+        partners = np.flatnonzero(inter)
+        units_a.append(np.full(len(partners), i))
+        units_b.append(partners)
+        shared.append(inter[partners])
+        min_sums.append(min_sum[partners])
+
+    if not units_a:
+        return pd.DataFrame(columns=columns)
+
+    a = np.concatenate(units_a)
+    b = np.concatenate(units_b)
+    inter = np.concatenate(shared)
+    min_sum = np.concatenate(min_sums)
+    labels = np.asarray(matrix.units, dtype=object)
+    return pd.DataFrame({
+        'unit_a': labels[a],
+        'unit_b': labels[b],
+        'shared_taxa': inter,
+        'jaccard': inter / (richness[a] + richness[b] - inter),
+        'bray_curtis': 2 * min_sum / (totals[a] + totals[b]),
+    })[columns]
@@ -58,5 +58,5 @@ class SpeccountMultiPlugin:
         
     def run_multi_count(self):
         """Lance la boîte de dialogue de comptage multi-couches."""
-        dialog = SpecCountMultiDialog(self.iface.mainWindow())
+        dialog = SpecCountMultiDialog(self.iface.mainWindow(), iface=self.iface)
         dialog.exec_()
\ No newline at end of file
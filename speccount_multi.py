@@ -3,26 +3,153 @@ Plugin QGIS pour le comptage des espèces à partir de TAXREF - Version Multi-co
 """
 
 import os
+import math
 from qgis.PyQt.QtWidgets import (QDialog, QVBoxLayout, QHBoxLayout, QPushButton, 
                                 QListWidget, QLabel, QComboBox, QProgressBar,
                                 QListWidgetItem, QAbstractItemView, QMessageBox,
-                                QGroupBox, QTableWidget, QTableWidgetItem,
-                                QHeaderView, QCheckBox, QFileDialog, QDialogButtonBox)
-from qgis.PyQt.QtCore import Qt, QMetaType
+                                QGroupBox, QTableView, QLineEdit,
+                                QCheckBox, QFileDialog, QDialogButtonBox, QDoubleSpinBox)
+from qgis.PyQt.QtCore import (Qt, QMetaType, QAbstractTableModel, QModelIndex,
+                              QSortFilterProxyModel)
 from qgis.core import (QgsProject, QgsVectorLayer, QgsFeature, QgsFields, QgsField,
-                      QgsMessageLog, Qgis, QgsVectorFileWriter, QgsMapLayerProxyModel)
-from qgis.gui import QgsMapLayerComboBox, QgsFileWidget
-from .utils import (get_cd_ref_from_cd_nom, get_tri_rang, get_taxsup)
+                      QgsMessageLog, Qgis, QgsVectorFileWriter, QgsMapLayerProxyModel, NULL,
+                      QgsFeatureRequest, QgsExpression, QgsExpressionContext,
+                      QgsExpressionContextUtils, QgsCoordinateTransform, QgsGeometry,
+                      QgsVectorDataProvider, QgsVectorLayerJoinInfo)
+from qgis.gui import QgsMapLayerComboBox, QgsFileWidget, QgsExpressionLineEdit
+from .utils import (get_cd_ref_from_cd_nom, get_tri_rang, get_taxsup,
+                    build_name_index, build_ngram_index, resolve_taxon_names,
+                    build_nested_set_index, clade_mask,
+                    event_keys, event_hashes, hyperloglog_registers, hyperloglog_estimate,
+                    resolve_to_rank, taxonomy_rollup)
+from .diversity import (diversity_indices, rarefaction_curves, DIVERSITY_COLUMNS,
+                        build_abundance_matrix, save_abundance_matrix, pairwise_similarity)
 from functools import reduce
+import numpy as np
 import pandas as pd
 
 
+# Colonnes du récapitulatif : (clé dans les résultats, en-tête affiché)
+SUMMARY_COLUMNS = [
+    ('input_layer', "Couche d'entrée"),
+    ('output_layer_name', "Couche de sortie"),
+    ('num_observations', "Nb observations"),
+    ('species_count', "Nb espèces"),
+    ('imprecis_count', "Nb imprécis"),
+    ('no_matching_rank_count', "Nb sans correspondance"),
+    ('output_file', "Fichier de sortie"),
+    ('shannon', "Shannon"),
+    ('simpson', "Simpson"),
+    ('chao1', "Chao1"),
+    ('ace', "ACE"),
+    ('unresolved_names_count', "Noms non résolus"),
+    ('ambiguous_names_count', "Noms ambigus"),
+]
+# Filtres spatiaux des entités
+EXTENT_ALL, EXTENT_CANVAS, EXTENT_MASK = range(3)
+EXTENT_MODES = [
+    "Toute la couche",
+    "Emprise courante de la carte",
+    "Masque polygonal",
+]
+
+# Annotation des observations avec le taxon sous lequel elles sont comptées
+ANNOTATE_NONE, ANNOTATE_JOIN, ANNOTATE_WRITE = range(3)
+ANNOTATION_MODES = [
+    "Aucune",
+    "Table d'annotation jointe aux couches sources",
+    "Écriture dans les couches sources",
+]
+# Champs d'annotation (noms courts compatibles shapefile) : (nom, type, colonne de resolve_to_rank)
+ANNOTATION_FIELDS = [
+    ('spc_cd_ref', QMetaType.Int, 'cd_ref'),
+    ('spc_nom', QMetaType.QString, 'nom'),
+    ('spc_rang', QMetaType.QString, 'id_rang'),
+    ('spc_statut', QMetaType.QString, 'statut'),
+]
+
+# Modes de comptage : nombre d'observations brut ou nombre d'événements distincts par taxon
+COUNT_OBSERVATIONS, COUNT_EVENTS_EXACT, COUNT_EVENTS_APPROX = range(3)
+COUNT_MODES = [
+    "Nombre d'observations",
+    "Événements distincts (exact)",
+    "Événements distincts (approché, HyperLogLog)",
+]
+
+SUMMARY_FLOAT_COLUMNS = {'shannon', 'simpson', 'chao1', 'ace'}
+SUMMARY_INT_COLUMNS = {'num_observations', 'species_count', 'imprecis_count', 'no_matching_rank_count',
+                       'unresolved_names_count', 'ambiguous_names_count'}
+
+
+def results_to_dataframe(results_data):
+    """Construire le DataFrame du récapitulatif (une ligne par couche) à partir des résultats de traitement."""
+    rows = []
+    for input_layer, result_info in results_data.items():
+        if isinstance(result_info, dict):  # Traitement réussi
+            row = {key: result_info.get(key) for key, _ in SUMMARY_COLUMNS}
+            output_file = result_info.get('output_path') or 'Couche temporaire'
+            row['output_file'] = os.path.basename(output_file) if output_file != 'Couche temporaire' else output_file
+        else:  # Erreur
+            row = {'output_layer_name': "ERREUR", 'output_file': str(result_info)}
+        row['input_layer'] = input_layer
+        rows.append(row)
+    df = pd.DataFrame(rows, columns=[key for key, _ in SUMMARY_COLUMNS])
+    # Entiers nullables : les lignes en erreur ne transforment pas les effectifs en décimaux
+    return df.astype({col: 'Int64' for col in SUMMARY_INT_COLUMNS}).astype({col: 'float64' for col in SUMMARY_FLOAT_COLUMNS})
+
+
+class DataFrameTableModel(QAbstractTableModel):
+    """Modèle Qt en lecture seule sur un DataFrame : seules les cellules visibles sont rendues."""
+
+    def __init__(self, df, headers=None, float_columns=(), parent=None):
+        super().__init__(parent)
+        self.df = df
+        self.headers = headers if headers is not None else [str(col) for col in df.columns]
+        self.float_columns = {df.columns.get_loc(col) for col in float_columns if col in df.columns}
+        # Accès positionnel rapide aux valeurs, colonne par colonne
+        self._values = [df[col].to_numpy(dtype=object) for col in df.columns]
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.df)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.df.columns)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        value = self._values[index.column()][index.row()]
+        missing = value is None or (not isinstance(value, str) and pd.isna(value))
+        if role == Qt.DisplayRole:
+            if missing:
+                return "-"
+            if index.column() in self.float_columns:
+                return f"{value:.2f}"
+            return str(value)
+        if role == Qt.UserRole:
+            # Valeur brute utilisée pour le tri
+            if missing:
+                return None
+            return value.item() if hasattr(value, 'item') else value
+        if role == Qt.TextAlignmentRole and not missing and not isinstance(value, str):
+            return int(Qt.AlignRight | Qt.AlignVCenter)
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return self.headers[section]
+        return str(section + 1)
+
+
 class ResultsSummaryDialog(QDialog):
     """Fenêtre récapitulative des résultats de traitement."""
     
     def __init__(self, results_data, output_folder=None, parent=None):
         super().__init__(parent)
         self.results_data = results_data
+        self.results_df = results_to_dataframe(results_data)
         self.output_folder = output_folder
         self.setWindowTitle("Récapitulatif des traitements")
         self.setModal(True)
@@ -37,66 +164,59 @@ class ResultsSummaryDialog(QDialog):
         title_label = QLabel("Récapitulatif des traitements par couche")
         title_label.setStyleSheet("font-size: 14px; font-weight: bold; margin: 10px;")
         layout.addWidget(title_label)
+
+        # Filtre sur toutes les colonnes
+        self.filter_edit = QLineEdit()
+        self.filter_edit.setPlaceholderText("Filtrer les couches...")
+        self.filter_edit.setClearButtonEnabled(True)
+        layout.addWidget(self.filter_edit)
         
-        # Tableau des résultats
-        self.results_table = QTableWidget()
-        headers = [
-            "Couche d'entrée", 
-            "Couche de sortie",
-            "Nb observations" 
-            "Nb espèces", 
-            "Nb imprécis", 
-            "Nb sans correspondance",
-            "Fichier de sortie"
-        ]
-        self.results_table.setColumnCount(len(headers))
-        self.results_table.setHorizontalHeaderLabels(headers)
-        self.results_table.setRowCount(len(self.results_data))
-        
-        # Remplir le tableau
-        for row, (input_layer, result_info) in enumerate(self.results_data.items()):
-            if isinstance(result_info, dict):  # Traitement réussi
-                self.results_table.setItem(row, 0, QTableWidgetItem(input_layer))
-                self.results_table.setItem(row, 1, QTableWidgetItem(result_info['output_layer_name']))
-                self.results_table.setItem(row, 2, QTableWidgetItem(str(result_info['num_observations'])))
-                self.results_table.setItem(row, 3, QTableWidgetItem(str(result_info['species_count'])))
-                self.results_table.setItem(row, 4, QTableWidgetItem(str(result_info['imprecis_count'])))
-                self.results_table.setItem(row, 5, QTableWidgetItem(str(result_info['no_matching_rank_count'])))
-
-                output_file = result_info.get('output_path', 'Couche temporaire')
-                if output_file and output_file != 'Couche temporaire':
-                    output_file = os.path.basename(output_file)
-                self.results_table.setItem(row, 6, QTableWidgetItem(output_file))
-            else:  # Erreur
-                self.results_table.setItem(row, 0, QTableWidgetItem(input_layer))
-                self.results_table.setItem(row, 1, QTableWidgetItem("ERREUR"))
-                self.results_table.setItem(row, 2, QTableWidgetItem("-"))
-                self.results_table.setItem(row, 3, QTableWidgetItem("-"))
-                self.results_table.setItem(row, 4, QTableWidgetItem("-"))
-                self.results_table.setItem(row, 5, QTableWidgetItem("-"))
-        
-        # Ajuster la taille des colonnes
-        self.results_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
-        self.results_table.horizontalHeader().setStretchLastSection(True)
+        # Tableau des résultats (modèle/vue, tri et filtre via un proxy)
+        self.results_model = DataFrameTableModel(self.results_df, [header for _, header in SUMMARY_COLUMNS],
+                                                 SUMMARY_FLOAT_COLUMNS, self)
+        self.proxy_model = QSortFilterProxyModel(self)
+        self.proxy_model.setSourceModel(self.results_model)
+        self.proxy_model.setSortRole(Qt.UserRole)
+        self.proxy_model.setFilterKeyColumn(-1)
+        self.proxy_model.setFilterCaseSensitivity(Qt.CaseInsensitive)
+        self.filter_edit.textChanged.connect(self.proxy_model.setFilterFixedString)
+
+        self.results_table = QTableView()
+        self.results_table.setModel(self.proxy_model)
+        self.results_table.setSortingEnabled(True)
+        self.results_table.sortByColumn(-1, Qt.AscendingOrder)
+        self.results_table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        
+        # Ajuster la taille des colonnes sur un échantillon de lignes seulement
+        header = self.results_table.horizontalHeader()
+        header.setResizeContentsPrecision(100)
+        self.results_table.resizeColumnsToContents()
+        header.setStretchLastSection(True)
         layout.addWidget(self.results_table)
         
         # Statistiques globales
         stats_group = QGroupBox("Statistiques globales")
         stats_layout = QVBoxLayout(stats_group)
         
-        successful_treatments = [r for r in self.results_data.values() if isinstance(r, dict)]
-        total_species = sum(r['species_count'] for r in successful_treatments)
-        total_imprecis = sum(r['imprecis_count'] for r in successful_treatments)
-        total_no_match = sum(r['no_matching_rank_count'] for r in successful_treatments)
-        total_observations = sum(r['num_observations'] for r in successful_treatments)
+        successful = self.results_df[self.results_df['output_layer_name'] != "ERREUR"]
+        total_species = int(successful['species_count'].sum())
+        total_imprecis = int(successful['imprecis_count'].sum())
+        total_no_match = int(successful['no_matching_rank_count'].sum())
+        total_observations = int(successful['num_observations'].sum())
+        total_unresolved = int(successful['unresolved_names_count'].fillna(0).sum())
+        total_ambiguous = int(successful['ambiguous_names_count'].fillna(0).sum())
         
         stats_text = f"""
-        Couches traitées avec succès : {len(successful_treatments)} / {len(self.results_data)}
+        Couches traitées avec succès : {len(successful)} / {len(self.results_df)}
         Nombre d'observations totales traitées : {total_observations}
         Total espèces trouvées : {total_species}
         Total observations imprécises : {total_imprecis}
         Total observations sans correspondance : {total_no_match}
         """
+        if successful['unresolved_names_count'].notna().any():
+            stats_text += f"""Total noms scientifiques non résolus : {total_unresolved}
+        Total noms scientifiques ambigus : {total_ambiguous}
+        """
         
         stats_label = QLabel(stats_text)
         stats_label.setStyleSheet("font-family: monospace; margin: 10px;")
@@ -106,6 +226,10 @@ class ResultsSummaryDialog(QDialog):
         # Boutons
         button_layout = QHBoxLayout()
         
+        self.export_btn = QPushButton("Exporter le récapitulatif...")
+        self.export_btn.clicked.connect(self.export_summary)
+        button_layout.addWidget(self.export_btn)
+
         # Bouton pour ouvrir le dossier de sortie
         if self.output_folder and self.output_folder not in ["Selectionnez un dossier de sortie si besoin", ""]:
             self.open_folder_btn = QPushButton("Ouvrir le dossier de sortie")
@@ -120,6 +244,27 @@ class ResultsSummaryDialog(QDialog):
         
         layout.addLayout(button_layout)
         
+    def export_summary(self):
+        """Exporter le récapitulatif (lignes filtrées, dans l'ordre affiché) en CSV."""
+        default_path = os.path.join(self.output_folder, "speccount_recapitulatif.csv") if self.output_folder else "speccount_recapitulatif.csv"
+        file_path, _ = QFileDialog.getSaveFileName(
+            self,
+            "Exporter le récapitulatif",
+            default_path,
+            "Fichiers CSV (*.csv)"
+        )
+        if not file_path:
+            return
+
+        rows = [self.proxy_model.mapToSource(self.proxy_model.index(row, 0)).row()
+                for row in range(self.proxy_model.rowCount())]
+        summary_df = self.results_df.iloc[rows].rename(columns=dict(SUMMARY_COLUMNS))
+        try:
+            summary_df.to_csv(file_path, index=False)
+            QgsMessageLog.logMessage(f"Récapitulatif sauvegardé : {file_path}", "Speccount", Qgis.Info)
+        except Exception as e:
+            QMessageBox.warning(self, "Erreur", f"Impossible d'exporter le récapitulatif : {str(e)}")
+
     def open_output_folder(self):
         """Ouvrir le dossier de sortie dans l'explorateur."""
         if not self.output_folder or not os.path.exists(self.output_folder):
@@ -135,8 +280,9 @@ class ResultsSummaryDialog(QDialog):
 class SpecCountMultiDialog(QDialog):
     """Boîte de dialogue pour le comptage multi-couches."""
     
-    def __init__(self, parent=None, taxref_df=None, taxrank_df=None):
+    def __init__(self, parent=None, taxref_df=None, taxrank_df=None, iface=None):
         super().__init__(parent)
+        self.iface = iface
         self.setWindowTitle("Comptage d'espèces - Multi-couches")
         self.setModal(True)
         self.resize(600, 500)
@@ -145,6 +291,9 @@ class SpecCountMultiDialog(QDialog):
         self.selected_layers = []
         self.taxref_df = taxref_df
         self.taxrank_df = taxrank_df
+        self.name_index = None
+        self.ngram_index = None
+        self.nested_set = None
         
         # Interface
         self.setup_ui()
@@ -192,6 +341,18 @@ class SpecCountMultiDialog(QDialog):
         self.cd_nom_combo.setEditable(True)
         self.cd_nom_combo.addItems(["cd_nom", "CD_NOM", "taxon_id", "espece_id"])
         param_layout.addWidget(self.cd_nom_combo)
+
+        # Correspondance par nom scientifique pour les couches sans cd_nom
+        self.name_matching_checkbox = QCheckBox("Le champ contient des noms scientifiques (correspondance avec les noms TAXREF)")
+        self.name_matching_checkbox.setToolTip("Les noms sont normalisés (casse, accents, espaces, auteurs) puis recherchés " \
+        "dans l'index des noms TAXREF pour obtenir le cd_nom.")
+        self.fuzzy_matching_checkbox = QCheckBox("Correspondance approchée pour les noms non trouvés")
+        self.fuzzy_matching_checkbox.setToolTip("Recherche le nom TAXREF le plus proche (trigrammes) pour les noms sans correspondance exacte. " \
+        "La construction de l'index approché prend quelques secondes lors de la première utilisation.")
+        self.fuzzy_matching_checkbox.setEnabled(False)
+        self.name_matching_checkbox.toggled.connect(self.fuzzy_matching_checkbox.setEnabled)
+        param_layout.addWidget(self.name_matching_checkbox)
+        param_layout.addWidget(self.fuzzy_matching_checkbox)
     
 
         # Rang taxonomique
@@ -214,6 +375,43 @@ class SpecCountMultiDialog(QDialog):
         self.rank_combo.setCurrentText('Espèce (Species)')
         param_layout.addWidget(self.rank_combo)
 
+        # Filtre taxonomique par clade
+        param_layout.addWidget(QLabel("Filtre taxonomique (optionnel) - cd_nom des clades, séparés par des virgules :"))
+        clade_layout = QHBoxLayout()
+        self.clade_edit = QLineEdit()
+        self.clade_edit.setPlaceholderText("Ex : 185961 (Aves)")
+        self.clade_mode_combo = QComboBox()
+        self.clade_mode_combo.addItems(["Inclure uniquement ces clades", "Exclure ces clades"])
+        clade_layout.addWidget(self.clade_edit)
+        clade_layout.addWidget(self.clade_mode_combo)
+        param_layout.addLayout(clade_layout)
+
+        # Mode de comptage
+        param_layout.addWidget(QLabel("Mode de comptage :"))
+        self.count_mode_combo = QComboBox()
+        self.count_mode_combo.addItems(COUNT_MODES)
+        self.count_mode_combo.setToolTip("Les événements distincts sont les combinaisons distinctes des champs choisis " \
+        "(et de la maille) par taxon, pour ne pas compter plusieurs fois une même observation répétée par individu ou par photo.")
+        param_layout.addWidget(self.count_mode_combo)
+
+        event_layout = QHBoxLayout()
+        self.event_fields_edit = QLineEdit()
+        self.event_fields_edit.setPlaceholderText("Champs définissant un événement, séparés par des virgules (ex : date, observateur)")
+        self.grid_size_spin = QDoubleSpinBox()
+        self.grid_size_spin.setDecimals(6)
+        self.grid_size_spin.setRange(0, 1000000)
+        self.grid_size_spin.setSpecialValueText("Sans maille")
+        self.grid_size_spin.setToolTip("Taille de la maille dans l'unité du SCR de la couche : la géométrie de chaque " \
+        "observation est ramenée à sa maille, qui fait alors partie de l'événement.")
+        event_layout.addWidget(self.event_fields_edit)
+        event_layout.addWidget(QLabel("Maille :"))
+        event_layout.addWidget(self.grid_size_spin)
+        param_layout.addLayout(event_layout)
+        self.event_fields_edit.setEnabled(False)
+        self.grid_size_spin.setEnabled(False)
+        self.count_mode_combo.currentIndexChanged.connect(
+            lambda index: [widget.setEnabled(index != COUNT_OBSERVATIONS) for widget in (self.event_fields_edit, self.grid_size_spin)])
+
         self.setup_advanced_taxon_ui()
         self.advanced_taxons_button = QPushButton("Gestion avancée des taxons importants...")
         self.advanced_taxons_button.clicked.connect(self.advanced_taxon_dialog_open)
@@ -226,7 +424,63 @@ class SpecCountMultiDialog(QDialog):
         # self.folder_widget.setCaption("Création d'une couche temporaire")  # texte de base
         param_layout.addWidget(self.folder_widget)
 
+        # Export de la matrice couches × taxons (nécessite un dossier de sortie)
+        matrix_layout = QHBoxLayout()
+        self.matrix_checkbox = QCheckBox("Exporter la matrice couches × taxons et les similarités entre couches")
+        self.matrix_checkbox.setToolTip("Matrice creuse (CSR) des effectifs par cd_ref, accompagnée des tables d'index " \
+        "des couches et des taxons, et des similarités de Jaccard et de Bray-Curtis entre couches. Nécessite un dossier de sortie.")
+        self.matrix_format_combo = QComboBox()
+        self.matrix_format_combo.addItems(["npz", "parquet"])
+        matrix_layout.addWidget(self.matrix_checkbox)
+        matrix_layout.addWidget(self.matrix_format_combo)
+        param_layout.addLayout(matrix_layout)
+
         layout.addWidget(param_group)
+
+        # Groupe des filtres d'entités (transmis aux fournisseurs de données via QgsFeatureRequest)
+        filter_group = QGroupBox("Filtres des entités")
+        filter_layout = QVBoxLayout(filter_group)
+
+        self.selected_only_checkbox = QCheckBox("Entités sélectionnées uniquement")
+        filter_layout.addWidget(self.selected_only_checkbox)
+
+        extent_layout = QHBoxLayout()
+        self.extent_combo = QComboBox()
+        self.extent_combo.addItems(EXTENT_MODES)
+        if self.iface is None:
+            self.extent_combo.model().item(EXTENT_CANVAS).setEnabled(False)
+        self.mask_layer_combo = QgsMapLayerComboBox()
+        self.mask_layer_combo.setFilters(QgsMapLayerProxyModel.PolygonLayer)
+        self.mask_layer_combo.setEnabled(False)
+        self.extent_combo.currentIndexChanged.connect(lambda index: self.mask_layer_combo.setEnabled(index == EXTENT_MASK))
+        extent_layout.addWidget(self.extent_combo)
+        extent_layout.addWidget(self.mask_layer_combo)
+        filter_layout.addLayout(extent_layout)
+
+        filter_layout.addWidget(QLabel("Expression de filtre (optionnelle) :"))
+        self.filter_expression_edit = QgsExpressionLineEdit()
+        self.filter_expression_edit.setToolTip("Expression QGIS évaluée par le fournisseur de données lorsque c'est possible, " \
+        "ex : \"date_obs\" >= '2020-01-01' AND \"statut_validation\" = 'Certain'")
+        filter_layout.addWidget(self.filter_expression_edit)
+
+        layout.addWidget(filter_group)
+
+        # Annotation des observations
+        annotation_layout = QHBoxLayout()
+        annotation_layout.addWidget(QLabel("Annotation des observations :"))
+        self.annotation_combo = QComboBox()
+        self.annotation_combo.addItems(ANNOTATION_MODES)
+        self.annotation_combo.setToolTip("Associe à chaque observation le taxon sous lequel elle est comptée (cd_ref, nom, rang) " \
+        "ou son statut (imprécis, sans correspondance...). La table jointe ne modifie pas les données sources ; " \
+        "l'écriture ajoute les champs spc_* aux couches sources.")
+        annotation_layout.addWidget(self.annotation_combo)
+        layout.addLayout(annotation_layout)
+
+        # Arbre cumulé des taxons observés
+        self.rollup_checkbox = QCheckBox("Produire l'arbre cumulé des taxons observés (effectifs directs et cumulés par noeud)")
+        self.rollup_checkbox.setToolTip("Table parent / enfant de tous les taxons observés et de leurs ancêtres, avec la profondeur, " \
+        "le tri_rang, le nombre d'observations rattachées directement au taxon et le nombre cumulé sur tout son sous-arbre.")
+        layout.addWidget(self.rollup_checkbox)
         
         # Groupe de sélection des champs TAXREF
         fields_group = QGroupBox("Champs TAXREF à inclure dans les résultats")
@@ -400,6 +654,24 @@ class SpecCountMultiDialog(QDialog):
             QgsMessageLog.logMessage(f"Erreur lors du chargement des données : {str(e)}", 
                                    "Speccount", Qgis.Critical)
             
+    def get_name_indexes(self, fuzzy=False):
+        """Construire à la première utilisation les index des noms TAXREF (hachage et trigrammes)."""
+        if self.name_index is None:
+            self.name_index = build_name_index(self.taxref_df)
+            QgsMessageLog.logMessage(f"Index des noms TAXREF construit : {len(self.name_index)} noms", 
+                                   "Speccount", Qgis.Info)
+        if fuzzy and self.ngram_index is None:
+            self.ngram_index = build_ngram_index(self.name_index)
+        return self.name_index, self.ngram_index if fuzzy else None
+
+    def get_nested_set(self):
+        """Construire à la première utilisation la numérotation en ensembles imbriqués de l'arbre TAXREF."""
+        if self.nested_set is None:
+            self.nested_set = build_nested_set_index(self.taxref_df)
+            QgsMessageLog.logMessage(f"Arbre taxonomique indexé : {len(self.nested_set)} taxons", 
+                                   "Speccount", Qgis.Info)
+        return self.nested_set
+
     def populate_layers(self):
         """Remplir la liste des couches vectorielles."""
         self.layer_list.clear()
@@ -515,6 +787,26 @@ class SpecCountMultiDialog(QDialog):
             cd_refs = taxref_subset['cd_ref'].unique().tolist()
             return cd_refs, self.adv_taxon_force_ascent.isChecked()
 
+    def get_clade_filter_options(self):
+        """Récupérer les cd_ref des racines du filtre taxonomique et le mode (exclusion ou inclusion)."""
+        exclude = self.clade_mode_combo.currentIndex() == 1
+        cd_noms = []
+        for value in self.clade_edit.text().replace(';', ',').split(','):
+            if not value.strip():
+                continue
+            try:
+                cd_noms.append(int(value))
+            except ValueError:
+                QMessageBox.warning(self, "Attention", f"Identifiant taxonomique invalide dans le filtre taxonomique : '{value.strip()}'")
+        if not cd_noms:
+            return [], exclude
+
+        # Convertir les cd_nom en cd_ref
+        taxref_subset = self.taxref_df[self.taxref_df['cd_nom'].isin(cd_noms)]
+        if len(taxref_subset) < len(set(cd_noms)):
+            QMessageBox.warning(self, "Attention", "Certains identifiants du filtre taxonomique n'existent pas dans TAXREF.")
+        return taxref_subset['cd_ref'].unique().tolist(), exclude
+
     def process_layers(self):
         """Traiter les couches sélectionnées."""
         selected_layers = self.get_selected_layers()
@@ -527,6 +819,29 @@ class SpecCountMultiDialog(QDialog):
         if self.taxref_df is None or self.taxrank_df is None:
             QMessageBox.critical(self, "Erreur", "Les données TAXREF ne sont pas chargées.")
             return
+
+        self.clade_roots, self.clade_exclude = self.get_clade_filter_options()
+
+        self.count_mode = self.count_mode_combo.currentIndex()
+        self.event_fields = [f.strip() for f in self.event_fields_edit.text().split(',') if f.strip()]
+        self.grid_size = self.grid_size_spin.value()
+        self.annotation_mode = self.annotation_combo.currentIndex()
+        if self.count_mode != COUNT_OBSERVATIONS and not self.event_fields and not self.grid_size:
+            QMessageBox.warning(self, "Attention", "Veuillez indiquer au moins un champ ou une maille définissant un événement.")
+            return
+
+        if not self.get_feature_filter_options():
+            return
+
+        if self.annotation_mode == ANNOTATE_WRITE:
+            answer = QMessageBox.question(
+                self, "Confirmation",
+                "Les champs spc_* vont être ajoutés et remplis directement dans les couches sources, "
+                "sans passer par le mode édition : cette modification est définitive et ne pourra pas être annulée.\n\n"
+                "Continuer ?",
+                QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+            if answer != QMessageBox.Yes:
+                return
             
         cd_nom_field = self.cd_nom_combo.currentText()
         rank_text = self.rank_combo.currentText()
@@ -577,11 +892,299 @@ class SpecCountMultiDialog(QDialog):
         self.progress_bar.setVisible(False)
         self.process_btn.setEnabled(True)
         
-        # Afficher la fenêtre de récapitulatif
         output_folder = self.folder_widget.filePath() if self.folder_widget.filePath() not in ["Selectionnez un dossier de sortie si besoin", ""] else None
+        self.add_diversity_metrics(results_data, output_folder)
+        if self.matrix_checkbox.isChecked():
+            self.export_abundance_matrix(results_data, output_folder)
+
+        # Afficher la fenêtre de récapitulatif
         summary_dialog = ResultsSummaryDialog(results_data, output_folder, self)
         summary_dialog.exec_()
         
+    def add_diversity_metrics(self, results_data, output_folder=None):
+        """Calculer les indices de diversité de toutes les couches traitées en une seule passe
+        et les ajouter aux résultats, puis les exporter en CSV si un dossier de sortie est défini."""
+        successful = {name: r for name, r in results_data.items() if isinstance(r, dict)}
+        if not successful:
+            return
+
+        taxon_counts = {name: r['taxon_counts'] for name, r in successful.items()}
+        metrics = diversity_indices(taxon_counts)
+        for name, result in successful.items():
+            result.update(metrics.loc[name, DIVERSITY_COLUMNS].to_dict())
+
+        if output_folder:
+            metrics_path = os.path.join(output_folder, "speccount_diversite.csv")
+            metrics.to_csv(metrics_path)
+            QgsMessageLog.logMessage(f"Indices de diversité sauvegardés : {metrics_path}", "Speccount", Qgis.Info)
+
+            curves_path = os.path.join(output_folder, "speccount_rarefaction.csv")
+            rarefaction_curves(taxon_counts).to_csv(curves_path, index=False)
+            QgsMessageLog.logMessage(f"Courbes de raréfaction sauvegardées : {curves_path}", "Speccount", Qgis.Info)
+
+    def export_abundance_matrix(self, results_data, output_folder):
+        """Exporter la matrice creuse couches × taxons et les similarités entre couches."""
+        if not output_folder:
+            QMessageBox.warning(self, "Attention", "Un dossier de sortie est nécessaire pour exporter la matrice couches × taxons.")
+            return
+
+        taxon_counts = {name: r['taxon_counts'] for name, r in results_data.items() if isinstance(r, dict)}
+        if not taxon_counts:
+            return
+
+        matrix = build_abundance_matrix(taxon_counts)
+        paths = save_abundance_matrix(matrix, output_folder, taxon_table=self.taxref_df,
+                                      fmt=self.matrix_format_combo.currentText())
+        similarity_path = os.path.join(output_folder, "speccount_similarites.parquet")
+        pairwise_similarity(matrix).to_parquet(similarity_path, index=False)
+        paths.append(similarity_path)
+
+        QgsMessageLog.logMessage(f"Matrice couches × taxons ({len(matrix.units)} × {len(matrix.taxa)}) sauvegardée : " \
+                                 f"{', '.join(paths)}", "Speccount", Qgis.Info)
+
+    def get_feature_filter_options(self):
+        """Récupérer les filtres d'entités (sélection, emprise ou masque, expression). Renvoie False si invalides."""
+        self.selected_only = self.selected_only_checkbox.isChecked()
+        self.filter_expression = self.filter_expression_edit.expression().strip()
+        self.filter_geometry, self.filter_crs, self.filter_exact = None, None, False
+
+        if self.filter_expression:
+            expression = QgsExpression(self.filter_expression)
+            if expression.hasParserError():
+                QMessageBox.warning(self, "Attention", f"Expression de filtre invalide : {expression.parserErrorString()}")
+                return False
+
+        extent_mode = self.extent_combo.currentIndex()
+        if extent_mode == EXTENT_CANVAS and self.iface is not None:
+            canvas = self.iface.mapCanvas()
+            self.filter_geometry = QgsGeometry.fromRect(canvas.extent())
+            self.filter_crs = canvas.mapSettings().destinationCrs()
+        elif extent_mode == EXTENT_MASK:
+            mask_layer = self.mask_layer_combo.currentLayer()
+            if mask_layer is None:
+                QMessageBox.warning(self, "Attention", "Veuillez choisir une couche de masque polygonal.")
+                return False
+            request = QgsFeatureRequest().setNoAttributes()
+            features = mask_layer.getSelectedFeatures(request) if mask_layer.selectedFeatureCount() else mask_layer.getFeatures(request)
+            self.filter_geometry = QgsGeometry.unaryUnion([f.geometry() for f in features if f.hasGeometry()])
+            if self.filter_geometry is None or self.filter_geometry.isEmpty():
+                QMessageBox.warning(self, "Attention", "La couche de masque ne contient aucune géométrie.")
+                return False
+            self.filter_crs = mask_layer.crs()
+            self.filter_exact = True
+        return True
+
+    def build_feature_request(self, layer, attributes, needs_geometry):
+        """Construire la requête d'entités d'une couche à partir des filtres choisis.
+
+        Le rectangle d'emprise, l'expression et la sélection sont transmis au fournisseur de données,
+        qui peut utiliser ses index spatiaux et attributaires. Renvoie la requête et, si nécessaire,
+        un test complémentaire à appliquer à chaque entité renvoyée (intersection exacte avec le masque,
+        expression lorsqu'elle est combinée à la sélection)."""
+        request = QgsFeatureRequest()
+        checks = []
+
+        expression = QgsExpression(self.filter_expression) if self.filter_expression else None
+        if self.selected_only:
+            request.setFilterFids(layer.selectedFeatureIds())
+            if expression is not None:
+                # Sélection et expression ne peuvent pas être combinées dans une même requête
+                context = QgsExpressionContext(QgsExpressionContextUtils.globalProjectLayerScopes(layer))
+                expression.prepare(context)
+
+                def matches_expression(feature):
+                    context.setFeature(feature)
+                    return bool(expression.evaluate(context))
+                checks.append(matches_expression)
+                needs_geometry = needs_geometry or expression.needsGeometry()
+                attributes = None
+        elif expression is not None:
+            request.setFilterExpression(self.filter_expression)
+            request.setExpressionContext(QgsExpressionContext(QgsExpressionContextUtils.globalProjectLayerScopes(layer)))
+
+        if self.filter_geometry is not None:
+            geometry = QgsGeometry(self.filter_geometry)
+            if self.filter_crs != layer.crs():
+                geometry.transform(QgsCoordinateTransform(self.filter_crs, layer.crs(), QgsProject.instance()))
+            request.setFilterRect(geometry.boundingBox())
+            if self.filter_exact:
+                engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+                engine.prepareGeometry()
+                checks.append(lambda feature: feature.hasGeometry() and engine.intersects(feature.geometry().constGet()))
+                needs_geometry = True
+
+        if not needs_geometry:
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+        if attributes is not None:
+            request.setSubsetOfAttributes(attributes, layer.fields())
+
+        if not checks:
+            return request, None
+        return request, lambda feature: all(check(feature) for check in checks)
+
+    def extract_observations(self, layer, cd_nom_field):
+        """Extraire de la couche le champ taxonomique et, selon le mode de comptage, les valeurs
+        des champs d'événement et la maille de chaque entité."""
+        name_mode = self.name_matching_checkbox.isChecked()
+        event_fields = self.event_fields if self.count_mode != COUNT_OBSERVATIONS else []
+        grid_size = self.grid_size if self.count_mode != COUNT_OBSERVATIONS else 0
+
+        request, accept = self.build_feature_request(layer, [cd_nom_field] + event_fields, needs_geometry=bool(grid_size))
+
+        fids, taxa, events, cells = [], [], [], []
+        for feature in layer.getFeatures(request):
+            if accept is not None and not accept(feature):
+                continue
+            fids.append(feature.id())
+            value = feature[cd_nom_field]
+            if name_mode:
+                taxa.append(value if isinstance(value, str) else None)
+            else:
+                try:
+                    taxa.append(int(value) if value is not None else None)
+                except (ValueError, TypeError):
+                    taxa.append(None)
+            if event_fields:
+                events.append(tuple(None if feature[f] == NULL else str(feature[f]) for f in event_fields))
+            if grid_size:
+                geometry = feature.geometry()
+                if geometry is None or geometry.isEmpty():
+                    cells.append(None)
+                else:
+                    point = geometry.centroid().asPoint()
+                    cells.append(f"{math.floor(point.x() / grid_size)}_{math.floor(point.y() / grid_size)}")
+
+        obs_df = pd.DataFrame({cd_nom_field: pd.Series(taxa, dtype=object)}, index=pd.Index(fids, name='fid'))
+        # Colonnes d'événement renommées pour ne pas entrer en conflit avec les colonnes taxonomiques
+        for i, field_name in enumerate(event_fields):
+            obs_df[f"_event_{i}"] = [event[i] for event in events]
+        if grid_size:
+            obs_df['_event_cell'] = cells
+        return obs_df
+
+    def annotation_values(self, cd_noms, wanted_rank):
+        """Calculer l'annotation de chaque valeur de cd_noms (Series, NaN si non résolu) en ne remontant
+        la hiérarchie que pour les cd_nom distincts. Renvoie un DataFrame aligné sur cd_noms."""
+        valid = cd_noms.dropna().astype('int64')
+        annotations = resolve_to_rank(valid, self.taxref_df, self.taxrank_df, wanted_rank,
+                                      self.important_taxons, self.force_ascent, self.clade_roots,
+                                      self.clade_exclude, self.get_nested_set() if self.clade_roots else None)
+        # reindex laisse vides les lignes sans cd_nom, y compris quand aucun cd_nom n'est valide
+        keys = cd_noms.fillna(-1).astype('int64')
+        values = annotations.reindex(keys).set_index(cd_noms.index)
+        missing_status = 'nom_non_resolu' if self.name_matching_checkbox.isChecked() else 'non_trouve'
+        values.loc[~keys.isin(annotations.index).to_numpy(), 'statut'] = missing_status
+        return values
+
+    def check_annotation_target(self, layer):
+        """Vérifier, avant tout traitement, que les champs spc_* pourront être écrits dans la couche source."""
+        provider = layer.dataProvider()
+        if layer.isEditable():
+            raise Exception("La couche est en cours d'édition : enregistrez ou annulez les modifications avant l'annotation")
+        if not provider.capabilities() & QgsVectorDataProvider.ChangeAttributeValues:
+            raise Exception("Le fournisseur de données ne permet pas de modifier les attributs de la couche")
+        if (any(layer.fields().indexOf(name) < 0 for name, _, _ in ANNOTATION_FIELDS)
+                and not provider.capabilities() & QgsVectorDataProvider.AddAttributes):
+            raise Exception("Le fournisseur de données ne permet pas d'ajouter les champs d'annotation")
+
+    def write_annotations(self, layer, cd_noms, wanted_rank):
+        """Écrire l'annotation dans les champs spc_* de la couche source, en un seul appel groupé au fournisseur."""
+        self.check_annotation_target(layer)
+        provider = layer.dataProvider()
+        missing_fields = [QgsField(name, field_type) for name, field_type, _ in ANNOTATION_FIELDS
+                          if layer.fields().indexOf(name) < 0]
+        if missing_fields:
+            provider.addAttributes(missing_fields)
+            layer.updateFields()
+
+        values = self.annotation_values(cd_noms, wanted_rank)
+        field_indexes = [layer.fields().indexOf(name) for name, _, _ in ANNOTATION_FIELDS]
+        columns = [values[column].astype(object).where(values[column].notna(), None).tolist()
+                   for _, _, column in ANNOTATION_FIELDS]
+        changes = {fid: dict(zip(field_indexes, row)) for fid, row in zip(values.index.tolist(), zip(*columns))}
+        if not provider.changeAttributeValues(changes):
+            raise Exception(f"Échec de l'écriture des annotations : {', '.join(provider.errors())}")
+        layer.triggerRepaint()
+        QgsMessageLog.logMessage(f"Annotations écrites sur {len(changes)} entités de {layer.name()}", "Speccount", Qgis.Info)
+
+    def join_annotation_table(self, layer, cd_nom_field, wanted_rank):
+        """Créer la table d'annotation (une ligne par valeur distincte du champ taxonomique) et la joindre
+        à la couche source : aucune donnée source n'est modifiée."""
+        key_index = layer.fields().indexOf(cd_nom_field)
+        raw = pd.Series([v for v in layer.uniqueValues(key_index) if v is not None and v != NULL], dtype=object)
+        if self.name_matching_checkbox.isChecked():
+            names = raw[raw.map(lambda value: isinstance(value, str))]
+            cd_noms, _ = resolve_taxon_names(names, *self.get_name_indexes(self.fuzzy_matching_checkbox.isChecked()))
+            cd_noms = cd_noms.reindex(raw.index)
+        else:
+            cd_noms = pd.to_numeric(raw, errors='coerce').astype(float).apply(np.floor)
+        values = self.annotation_values(cd_noms, wanted_rank)
+
+        table_name = f"{layer.name()}_speccount_annotation"
+        fields = QgsFields()
+        fields.append(QgsField(layer.fields().field(key_index)))
+        for name, field_type, _ in ANNOTATION_FIELDS:
+            fields.append(QgsField(name, field_type))
+        table = QgsVectorLayer("None", table_name, "memory")
+        table.dataProvider().addAttributes(fields)
+        table.updateFields()
+
+        columns = [values[column].astype(object).where(values[column].notna(), None).tolist()
+                   for _, _, column in ANNOTATION_FIELDS]
+        features = []
+        for key, row in zip(raw.tolist(), zip(*columns)):
+            feature = QgsFeature(table.fields())
+            feature.setAttributes([key] + list(row))
+            features.append(feature)
+        table.dataProvider().addFeatures(features)
+
+        # Remplacer la jointure et la table d'un traitement précédent
+        for join in layer.vectorJoins():
+            if join.joinLayer() is not None and join.joinLayer().name() == table_name:
+                old_table_id = join.joinLayerId()
+                layer.removeJoin(old_table_id)
+                QgsProject.instance().removeMapLayer(old_table_id)
+        QgsProject.instance().addMapLayer(table)
+
+        join_info = QgsVectorLayerJoinInfo()
+        join_info.setJoinLayer(table)
+        join_info.setJoinFieldName(cd_nom_field)
+        join_info.setTargetFieldName(cd_nom_field)
+        join_info.setUsingMemoryCache(True)
+        join_info.setPrefix('')
+        layer.addJoin(join_info)
+
+    def create_rollup_layer(self, layer, direct_counts):
+        """Créer la couche de l'arbre cumulé (une ligne par noeud du sous-arbre observé) et l'exporter en CSV
+        si un dossier de sortie est défini."""
+        rollup = taxonomy_rollup(direct_counts, self.get_nested_set(), self.taxref_df, self.taxrank_df)
+        if 'nom_complet' in self.taxref_df.columns:
+            names = self.taxref_df[['cd_nom', 'nom_complet']].drop_duplicates('cd_nom').set_index('cd_nom')['nom_complet']
+            rollup.insert(1, 'nom_complet', rollup['cd_ref'].map(names))
+
+        rollup_layer_name = f"{layer.name()}_speccount_arbre"
+        fields = QgsFields()
+        for column in rollup.columns:
+            field_type = QMetaType.QString if column in ('nom_complet', 'id_rang') else QMetaType.Int
+            fields.append(QgsField(column, field_type))
+        rollup_layer = QgsVectorLayer("None", rollup_layer_name, "memory")
+        rollup_layer.dataProvider().addAttributes(fields)
+        rollup_layer.updateFields()
+
+        columns = [rollup[column].astype(object).where(rollup[column].notna(), None).tolist() for column in rollup.columns]
+        features = []
+        for row in zip(*columns):
+            feature = QgsFeature(rollup_layer.fields())
+            feature.setAttributes([int(value) if isinstance(value, (int, float, np.integer)) else value for value in row])
+            features.append(feature)
+        rollup_layer.dataProvider().addFeatures(features)
+        QgsProject.instance().addMapLayer(rollup_layer)
+
+        if self.folder_widget.filePath() not in ["Selectionnez un dossier de sortie si besoin", ""]:
+            rollup_path = os.path.join(self.folder_widget.filePath(), f"{rollup_layer_name}.csv")
+            rollup.to_csv(rollup_path, index=False)
+            QgsMessageLog.logMessage(f"Arbre cumulé sauvegardé : {rollup_path}", "Speccount", Qgis.Info)
+
     def process_single_layer(self, layer, cd_nom_field, wanted_rank, selected_fields):
         """Traiter une seule couche."""
         # Vérifier que le champ cd_nom existe
@@ -589,25 +1192,52 @@ class SpecCountMultiDialog(QDialog):
         if cd_nom_field not in field_names:
             raise Exception(f"Le champ '{cd_nom_field}' n'existe pas dans la couche")
             
+        missing_fields = [f for f in self.event_fields if f not in field_names] if self.count_mode != COUNT_OBSERVATIONS else []
+        if missing_fields:
+            raise Exception(f"Champ(s) d'événement absent(s) de la couche : {', '.join(missing_fields)}")
+        if self.annotation_mode == ANNOTATE_WRITE:
+            self.check_annotation_target(layer)
+
         # Extraire les cd_nom de la couche
-        cd_noms = []
-        for feature in layer.getFeatures():
-            cd_nom = feature[cd_nom_field]
-            if cd_nom is not None:
-                try:
-                    cd_noms.append(int(cd_nom))
-                except (ValueError, TypeError):
-                    continue
+        obs_df = self.extract_observations(layer, cd_nom_field)
+        names_report = None
+        if self.name_matching_checkbox.isChecked():
+            # Noms scientifiques : résolution en cd_nom sur les valeurs distinctes
+            name_index, ngram_index = self.get_name_indexes(self.fuzzy_matching_checkbox.isChecked())
+            resolved, names_report = resolve_taxon_names(obs_df[cd_nom_field].dropna(), name_index, ngram_index)
+            obs_df[cd_nom_field] = resolved
+        # cd_nom de chaque entité, y compris non résolus, pour l'annotation faite après le comptage
+        feature_cd_noms = obs_df[cd_nom_field]
+        obs_df = obs_df.dropna(subset=[cd_nom_field])
                     
-        if not cd_noms:
+        if obs_df.empty:
             raise Exception("Aucun identifiant taxonomique valide trouvé")
             
-        obs_df = pd.DataFrame({cd_nom_field: cd_noms})
+        obs_df = obs_df.astype({cd_nom_field: 'int64'})
+        if self.count_mode != COUNT_OBSERVATIONS:
+            # Clé d'événement : identifiant exact ou hachage 64 bits pour HyperLogLog
+            event_columns = [col for col in obs_df.columns if col != cd_nom_field]
+            keys = event_keys(obs_df, event_columns) if self.count_mode == COUNT_EVENTS_EXACT else event_hashes(obs_df, event_columns)
+            obs_df = pd.DataFrame({cd_nom_field: obs_df[cd_nom_field].to_numpy(), 'event_key': keys.to_numpy()})
 
         # Traitement taxonomique
         # feedback.pushInfo('Traitement taxonomique...')
         obs_ref = get_tri_rang(get_cd_ref_from_cd_nom(obs_df, cd_nom_field, self.taxref_df), self.taxrank_df)
+
+        # Filtre taxonomique : un seul masque vectorisé sur les intervalles de l'arbre
+        if self.clade_roots:
+            in_clade = clade_mask(obs_ref['cd_ref'], self.clade_roots, self.get_nested_set())
+            obs_ref = obs_ref[~in_clade if self.clade_exclude else in_clade]
+            QgsMessageLog.logMessage(f"Filtre taxonomique sur {layer.name()} : {len(obs_ref)} / {len(obs_df)} observations conservées", 
+                                   "Speccount", Qgis.Info)
+            if obs_ref.empty:
+                QgsMessageLog.logMessage(f"Aucune observation de {layer.name()} dans les clades choisis : 0 espèce comptée",
+                                       "Speccount", Qgis.Warning)
+        num_observations = len(obs_ref)
         
+        if self.rollup_checkbox.isChecked():
+            self.create_rollup_layer(layer, obs_ref['cd_ref'].dropna().astype('int64').value_counts())
+
         condition_rank = obs_ref['tri_rang'] >= wanted_rank
         nb_imprecis = len(obs_ref[~condition_rank])
 
@@ -616,6 +1246,8 @@ class SpecCountMultiDialog(QDialog):
         # Comptage par niveau taxonomique
         value_counts = []
         no_matching_rank_num = 0
+        # Seule la clé d'événement accompagne les observations lors de la remontée
+        keep_columns = ('event_key',) if self.count_mode != COUNT_OBSERVATIONS else ()
 
         while len(obs_ref) > 0:
             no_matching_rank = obs_ref['tri_rang'] < wanted_rank
@@ -623,16 +1255,30 @@ class SpecCountMultiDialog(QDialog):
             obs_ref = obs_ref[~no_matching_rank]
             condition_rank = (obs_ref['tri_rang'] == wanted_rank)
             condition_taxon = (obs_ref['cd_ref'].isin(self.important_taxons))
-            value_counts.append(obs_ref[(condition_rank) | (condition_taxon)].value_counts('cd_ref'))
+            counted = obs_ref[(condition_rank) | (condition_taxon)]
+            if self.count_mode == COUNT_OBSERVATIONS:
+                value_counts.append(counted.value_counts('cd_ref'))
+            elif self.count_mode == COUNT_EVENTS_EXACT:
+                value_counts.append(counted[['cd_ref', 'event_key']].drop_duplicates())
+            else:
+                value_counts.append(hyperloglog_registers(counted['cd_ref'], counted['event_key']))
             if not self.force_ascent:
                 obs_ref = obs_ref[~(condition_rank | condition_taxon)]
             else:
                 obs_ref = obs_ref[~condition_rank]
             # feedback.pushInfo(f'Reste {len(obs_ref)} observations à traiter')
-            obs_ref = get_tri_rang(get_taxsup(obs_ref, self.taxref_df), self.taxrank_df)
+            obs_ref = get_tri_rang(get_taxsup(obs_ref, self.taxref_df, keep_columns=keep_columns), self.taxrank_df)
         
         # Création du DataFrame final
-        vc_total = reduce(lambda x, y: x.add(y, fill_value=0), value_counts).astype(int)
+        if not value_counts:
+            # Aucune observation au rang demandé (filtre taxonomique, observations toutes imprécises...)
+            vc_total = pd.Series([], index=pd.Index([], dtype='int64', name='cd_ref'), dtype='int64', name='count')
+        elif self.count_mode == COUNT_OBSERVATIONS:
+            vc_total = reduce(lambda x, y: x.add(y, fill_value=0), value_counts).astype(int)
+        elif self.count_mode == COUNT_EVENTS_EXACT:
+            vc_total = pd.concat(value_counts).drop_duplicates().value_counts('cd_ref')
+        else:
+            vc_total = hyperloglog_estimate(pd.concat(value_counts))
         final_df = pd.merge(pd.DataFrame(vc_total), 
                           self.taxref_df, 
                           left_index=True, 
@@ -662,7 +1308,8 @@ class SpecCountMultiDialog(QDialog):
                     field_type = QMetaType.QString
                 fields.append(QgsField(field_name, field_type))
         
-        fields.append(QgsField('count_observations', QMetaType.Int))
+        count_field = 'count_observations' if self.count_mode == COUNT_OBSERVATIONS else 'count_events'
+        fields.append(QgsField(count_field, QMetaType.Int))
         
         # Créer la couche de sortie
         output_layer = QgsVectorLayer("None", output_layer_name, "memory")
@@ -694,7 +1341,7 @@ class SpecCountMultiDialog(QDialog):
                         value = str(value)
                     feature.setAttribute(field_name, value)
             
-            feature.setAttribute('count_observations', int(row['count']))
+            feature.setAttribute(count_field, int(row['count']))
             
             features.append(feature)
             
@@ -715,11 +1362,26 @@ class SpecCountMultiDialog(QDialog):
             if error[0] == QgsVectorFileWriter.NoError:
                 QgsMessageLog.logMessage(f"Couche sauvegardée : {output_path}", "Speccount", Qgis.Info)
 
-        return {
+            if names_report is not None:
+                names_path = os.path.join(self.folder_widget.filePath(), f"{output_layer_name}_noms.csv")
+                names_report[names_report['statut'] != 'exact'].to_csv(names_path, index=False)
+
+        # L'annotation ne modifie la couche source qu'une fois le comptage réussi
+        if self.annotation_mode == ANNOTATE_WRITE:
+            self.write_annotations(layer, feature_cd_noms, wanted_rank)
+        elif self.annotation_mode == ANNOTATE_JOIN:
+            self.join_annotation_table(layer, cd_nom_field, wanted_rank)
+
+        result = {
             'species_count': len(final_df),
             'imprecis_count': nb_imprecis,
             'no_matching_rank_count': no_matching_rank_num,
             'output_layer_name': output_layer_name,
             'output_path': output_path,
-            'num_observations': len(obs_df)
+            'num_observations': num_observations,
+            'taxon_counts': vc_total
         }
+        if names_report is not None:
+            result['unresolved_names_count'] = int((names_report['statut'] == 'non_resolu').sum())
+            result['ambiguous_names_count'] = int((names_report['statut'] == 'ambigu').sum())
+        return result
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Les modules de calcul (utils.py, diversity.py) sont importables sans QGIS
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
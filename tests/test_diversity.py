@@ -0,0 +1,86 @@
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from diversity import ACE_RARE_THRESHOLD, diversity_indices, rarefaction_curves
+
+
+def make_counts():
+    return {
+        'mixte': pd.Series([15, 10, 5, 3, 2, 2, 1, 1, 40]),
+        'sans_doubleton': pd.Series([5, 1, 1, 3]),
+        'singletons': pd.Series([1, 1, 1]),
+        'abondants': pd.Series([20, 30]),
+        'vide': pd.Series([], dtype='int64'),
+        'zeros': pd.Series([0, 0]),
+    }
+
+
+def reference_indices(counts):
+    x = np.array([c for c in counts if c > 0], dtype=float)
+    if len(x) == 0:
+        return [0, 0, np.nan, np.nan, np.nan, np.nan]
+    n, s = x.sum(), len(x)
+    p = x / n
+    shannon = -sum(pi * math.log(pi) for pi in p)
+    simpson = 1 - sum(pi ** 2 for pi in p)
+    f1, f2 = (x == 1).sum(), (x == 2).sum()
+    if f2 > 0:
+        chao1 = s + (n - 1) / n * f1 ** 2 / (2 * f2)
+    else:
+        chao1 = s + (n - 1) / n * f1 * (f1 - 1) / 2
+
+    rare = x[x <= ACE_RARE_THRESHOLD]
+    if len(rare) == 0:
+        ace = s
+    else:
+        n_rare = rare.sum()
+        coverage = 1 - f1 / n_rare
+        if coverage <= 0:
+            ace = chao1
+        else:
+            gamma2 = max(len(rare) / coverage * (rare * (rare - 1)).sum() / (n_rare * (n_rare - 1)) - 1, 0)
+            ace = (s - len(rare)) + len(rare) / coverage + f1 / coverage * gamma2
+    return [n, s, shannon, simpson, chao1, ace]
+
+
+def test_diversity_indices_match_per_unit_formulas():
+    taxon_counts = make_counts()
+    result = diversity_indices(taxon_counts)
+    assert list(result.index) == list(taxon_counts)
+    for unit, counts in taxon_counts.items():
+        expected = reference_indices(counts)
+        assert result.loc[unit].tolist() == pytest.approx(expected, nan_ok=True), unit
+
+
+def test_ace_fallbacks():
+    result = diversity_indices(make_counts())
+    # Aucun taxon rare : ACE vaut la richesse observée
+    assert result.loc['abondants', 'ace'] == 2
+    # Tous les taxons rares sont des singletons : couverture nulle, repli sur Chao1
+    assert result.loc['singletons', 'ace'] == result.loc['singletons', 'chao1']
+    assert result.loc[['vide', 'zeros'], ['nb_individuals', 'richness']].to_numpy().tolist() == [[0, 0], [0, 0]]
+    assert result.loc[['vide', 'zeros'], ['shannon', 'simpson', 'chao1', 'ace']].isna().all().all()
+
+
+def test_rarefaction_matches_hurlbert():
+    taxon_counts = make_counts()
+    curves = rarefaction_curves(taxon_counts, nb_points=10)
+    assert set(curves['unit']) == {'mixte', 'sans_doubleton', 'singletons', 'abondants'}
+
+    for unit, group in curves.groupby('unit'):
+        x = [int(c) for c in taxon_counts[unit] if c > 0]
+        n = sum(x)
+        observed = group[group['method'] == 'observed']
+        assert observed['m'].tolist() == [n]
+        assert observed['richness'].iloc[0] == pytest.approx(len(x))
+
+        rarefied = group[group['method'] == 'rarefaction']
+        assert (rarefied['m'] < n).all()
+        for m, richness in zip(rarefied['m'], rarefied['richness']):
+            expected = sum(1 - math.comb(n - xi, m) / math.comb(n, m) for xi in x)
+            assert richness == pytest.approx(expected), (unit, m)
+
+        assert (group.loc[group['method'] == 'extrapolation', 'm'] > n).all()
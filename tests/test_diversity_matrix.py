@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+from diversity import build_abundance_matrix, pairwise_similarity, save_abundance_matrix
+
+
+def make_counts():
+    return {
+        'a': pd.Series([5, 2, 1], index=[30, 10, 20]),
+        'b': pd.Series([3, 4, 0], index=[10, 40, 20]),
+        'c': pd.Series([7], index=[50]),
+        'vide': pd.Series([], dtype='int64'),
+        'd': pd.Series([1, 2, 6], index=[20, 30, 40]),
+    }
+
+
+def dense_from_counts(taxon_counts, taxa):
+    dense = np.zeros((len(taxon_counts), len(taxa)), dtype=np.int64)
+    for i, counts in enumerate(taxon_counts.values()):
+        for cd_ref, count in counts.items():
+            if count > 0:
+                dense[i, list(taxa).index(cd_ref)] = count
+    return dense
+
+
+def dense_from_matrix(matrix):
+    dense = np.zeros((len(matrix.units), len(matrix.taxa)), dtype=np.int64)
+    for i in range(len(matrix.units)):
+        start, end = matrix.indptr[i], matrix.indptr[i + 1]
+        dense[i, matrix.indices[start:end]] = matrix.data[start:end]
+    return dense
+
+
+def test_csr_matrix_rebuilds_the_counts():
+    taxon_counts = make_counts()
+    matrix = build_abundance_matrix(taxon_counts)
+    assert matrix.units == list(taxon_counts)
+    assert matrix.taxa.tolist() == [10, 20, 30, 40, 50]
+    assert np.diff(matrix.indptr).tolist() == [3, 2, 1, 0, 3]
+    for i in range(len(matrix.units)):
+        assert np.all(np.diff(matrix.indices[matrix.indptr[i]:matrix.indptr[i + 1]]) > 0)
+    assert np.array_equal(dense_from_matrix(matrix), dense_from_counts(taxon_counts, matrix.taxa))
+
+
+def test_pairwise_similarity_matches_brute_force():
+    taxon_counts = make_counts()
+    matrix = build_abundance_matrix(taxon_counts)
+    dense = dense_from_matrix(matrix)
+    result = pairwise_similarity(matrix).set_index(['unit_a', 'unit_b'])
+
+    expected = {}
+    for i in range(len(matrix.units)):
+        for j in range(i + 1, len(matrix.units)):
+            x, y = dense[i], dense[j]
+            shared = int(((x > 0) & (y > 0)).sum())
+            if shared == 0:
+                continue
+            union = int(((x > 0) | (y > 0)).sum())
+            expected[(matrix.units[i], matrix.units[j])] = (
+                shared, shared / union, 2 * np.minimum(x, y).sum() / (x.sum() + y.sum()))
+
+    # Les paires sans taxon commun (avec 'c' ou 'vide') sont absentes
+    assert set(result.index) == set(expected)
+    for pair, (shared, jaccard, bray_curtis) in expected.items():
+        row = result.loc[pair]
+        assert row['shared_taxa'] == shared
+        assert np.isclose(row['jaccard'], jaccard)
+        assert np.isclose(row['bray_curtis'], bray_curtis)
+
+
+def test_save_abundance_matrix_round_trip(tmp_path):
+    matrix = build_abundance_matrix(make_counts())
+    dense = dense_from_matrix(matrix)
+    taxon_table = pd.DataFrame({'cd_nom': [10, 20, 30, 40, 50], 'nom_complet': list('vwxyz')})
+
+    npz_path, units_path, taxa_path = save_abundance_matrix(matrix, str(tmp_path), taxon_table=taxon_table)
+    with np.load(npz_path) as saved:
+        shape = tuple(saved['shape'])
+        rebuilt = np.zeros(shape, dtype=np.int64)
+        for i in range(shape[0]):
+            start, end = saved['indptr'][i], saved['indptr'][i + 1]
+            rebuilt[i, saved['indices'][start:end]] = saved['data'][start:end]
+    assert np.array_equal(rebuilt, dense)
+    assert pd.read_csv(units_path)['unit'].tolist() == matrix.units
+    taxa = pd.read_csv(taxa_path)
+    assert taxa['cd_ref'].tolist() == matrix.taxa.tolist()
+    assert taxa['nom_complet'].tolist() == list('vwxyz')
+
+    parquet_path, _, _ = save_abundance_matrix(matrix, str(tmp_path), basename='long', fmt='parquet')
+    long = pd.read_parquet(parquet_path)
+    rebuilt = np.zeros_like(dense)
+    rebuilt[long['unit_idx'], long['taxon_idx']] = long['count']
+    assert np.array_equal(rebuilt, dense)
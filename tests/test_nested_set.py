@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import build_nested_set_index, clade_mask
+
+
+def make_tree():
+    # 1 ─┬─ 2 ─┬─ 4
+    #    │     └─ 5 ── 8
+    #    └─ 3 ── 6
+    # 7 ── 9          (deuxième racine, cd_taxsup égal à lui-même)
+    # Les cd_nom 102 et 107 sont des synonymes de 2 et 7 utilisés comme cd_taxsup
+    return pd.DataFrame({
+        'cd_nom': [1, 2, 3, 4, 5, 6, 7, 8, 9, 102, 107],
+        'cd_ref': [1, 2, 3, 4, 5, 6, 7, 8, 9, 2, 7],
+        'cd_taxsup': [0, 1, 1, 102, 2, 3, 7, 5, 107, 1, 0],
+    })
+
+
+def reference_nested_set(taxon_table):
+    refs = taxon_table[taxon_table['cd_nom'] == taxon_table['cd_ref']]
+    nom_to_ref = dict(zip(taxon_table['cd_nom'], taxon_table['cd_ref']))
+    parents = {ref: nom_to_ref.get(sup, -1) for ref, sup in zip(refs['cd_ref'], refs['cd_taxsup'])}
+    parents = {ref: (-1 if parent == ref else parent) for ref, parent in parents.items()}
+    children = {ref: sorted(child for child, parent in parents.items() if parent == ref) for ref in parents}
+
+    numbering = {}
+
+    def visit(node, depth, counter):
+        left = counter
+        counter += 1
+        for child in children[node]:
+            counter = visit(child, depth + 1, counter)
+        numbering[node] = (parents[node], depth, counter - left, left, counter - 1)
+        return counter
+
+    counter = 0
+    for root in sorted(ref for ref, parent in parents.items() if parent == -1):
+        counter = visit(root, 0, counter)
+    return pd.DataFrame.from_dict(numbering, orient='index',
+                                  columns=['parent', 'depth', 'size', 'left', 'right']).sort_index()
+
+
+def test_nested_set_matches_recursive_dfs():
+    taxon_table = make_tree()
+    nested_set = build_nested_set_index(taxon_table)
+    expected = reference_nested_set(taxon_table)
+    assert nested_set.index.tolist() == expected.index.tolist()
+    assert nested_set.to_numpy().tolist() == expected.to_numpy().tolist()
+    assert nested_set.loc[4, 'parent'] == 2
+    assert nested_set.loc[9, 'parent'] == 7
+
+
+def test_cycle_raises():
+    taxon_table = pd.concat([make_tree(), pd.DataFrame({'cd_nom': [10, 11], 'cd_ref': [10, 11],
+                                                        'cd_taxsup': [11, 10]})])
+    with pytest.raises(Exception, match="cycle"):
+        build_nested_set_index(taxon_table)
+
+
+def test_clade_mask():
+    nested_set = build_nested_set_index(make_tree())
+    cd_refs = pd.Series([1, 2, 4, 5, 8, 3, 6, 7, 9, 999])
+
+    assert clade_mask(cd_refs, [2], nested_set).tolist() == [False, True, True, True, True,
+                                                             False, False, False, False, False]
+    # Racines imbriquées : le clade englobant l'emporte
+    assert np.array_equal(clade_mask(cd_refs, [5, 2], nested_set), clade_mask(cd_refs, [2], nested_set))
+    # Racines disjointes, racine inconnue ignorée
+    assert clade_mask(cd_refs, [6, 7, 12345], nested_set).tolist() == [False, False, False, False, False,
+                                                                       False, True, True, True, False]
+    assert clade_mask(cd_refs, [1, 7], nested_set).tolist() == [True] * 9 + [False]
+    assert not clade_mask(cd_refs, [12345], nested_set).any()
@@ -0,0 +1,49 @@
+import pandas as pd
+
+from utils import build_nested_set_index, taxonomy_rollup
+
+
+def make_taxonomy():
+    # 1 ─┬─ 2 ─┬─ 4
+    #    │     └─ 5 ── 8
+    #    └─ 3 ── 6
+    # 7 ── 9
+    taxon_table = pd.DataFrame({
+        'cd_nom': [1, 2, 3, 4, 5, 6, 7, 8, 9, 105],
+        'cd_ref': [1, 2, 3, 4, 5, 6, 7, 8, 9, 5],
+        'cd_taxsup': [0, 1, 1, 2, 2, 3, 0, 105, 7, 2],
+        'id_rang': ['KD', 'GN', 'GN', 'ES', 'ES', 'ES', 'KD', 'SSES', 'GN', 'ES'],
+    })
+    taxrank_table = pd.DataFrame({'id_rang': ['KD', 'GN', 'ES', 'SSES'], 'tri_rang': [20, 180, 220, 320]})
+    return taxon_table, taxrank_table
+
+
+def test_taxonomy_rollup():
+    taxon_table, taxrank_table = make_taxonomy()
+    nested_set = build_nested_set_index(taxon_table)
+    # Effectifs directs, avec un cd_ref répété et un cd_ref inconnu ignoré
+    direct_counts = pd.Series([3, 2, 1, 4, 1, 10], index=[4, 8, 5, 9, 4, 999])
+    rollup = taxonomy_rollup(direct_counts, nested_set, taxon_table, taxrank_table)
+
+    # Sous-arbre induit : taxons observés et tous leurs ancêtres
+    assert set(rollup['cd_ref']) == {1, 2, 4, 5, 8, 7, 9}
+    rollup = rollup.set_index('cd_ref', drop=False)
+    parents = rollup['cd_parent'].to_dict()
+    assert parents[1] == -1 and parents[7] == -1
+    assert parents[8] == 5
+
+    expected_direct = {1: 0, 2: 0, 4: 4, 5: 1, 8: 2, 7: 0, 9: 4}
+    assert rollup['count_direct'].to_dict() == expected_direct
+
+    def subtree_sum(node):
+        return expected_direct[node] + sum(subtree_sum(child) for child, parent in parents.items() if parent == node)
+
+    assert rollup['count_cumul'].to_dict() == {node: subtree_sum(node) for node in expected_direct}
+    assert rollup.loc[1, 'count_cumul'] == 7
+
+    # Un parent précède toujours ses enfants
+    order = {cd_ref: i for i, cd_ref in enumerate(rollup['cd_ref'])}
+    assert all(order[parent] < order[child] for child, parent in parents.items() if parent != -1)
+
+    assert rollup.loc[8, 'id_rang'] == 'SSES' and rollup.loc[8, 'tri_rang'] == 320
+    assert rollup.loc[1, 'depth'] == 0 and rollup.loc[8, 'depth'] == 3
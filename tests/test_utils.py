@@ -0,0 +1,120 @@
+import pandas as pd
+
+from utils import (build_name_index, build_nested_set_index, build_ngram_index, get_taxsup, normalize_taxon_names,
+                   resolve_taxon_names, resolve_to_rank)
+
+
+def make_taxref():
+    return pd.DataFrame({
+        'cd_nom': [1, 2, 3, 4, 5],
+        'cd_ref': [1, 2, 3, 4, 5],
+        'lb_nom': ['Canis lupus', 'Canis lupus italicus', 'Erica cinerea', 'Parus major', 'Parus minor'],
+        'nom_complet': ['Canis lupus Linnaeus, 1758', 'Canis lupus italicus Altobello, 1921',
+                        'Erica cinerea L.', 'Parus major Linnaeus, 1758', 'Parus minor Temminck & Schlegel, 1848'],
+    })
+
+
+def test_normalize_keeps_trinomials():
+    names = pd.Series(['Canis lupus italicus Altobello, 1921', 'Homo sapiens sapiens Linnaeus, 1758',
+                       'Quercus robur ssp. robur L.'])
+    assert normalize_taxon_names(names).tolist() == ['canis lupus italicus', 'homo sapiens sapiens',
+                                                     'quercus robur subsp. robur']
+
+
+def test_normalize_hybrids_and_author_particles():
+    names = pd.Series(['Ophrys x arachnitiformis Gren. & Philippe', 'x Cupressocyparis leylandii',
+                       'Genus de Candolle', 'Bellis perennis von Martens'])
+    assert normalize_taxon_names(names).tolist() == ['ophrys ×arachnitiformis', '×cupressocyparis leylandii',
+                                                     'genus', 'bellis perennis']
+
+
+def test_species_and_subspecies_are_distinct():
+    name_index = build_name_index(make_taxref())
+    names = pd.Series(['Canis lupus', 'Canis lupus italicus Altobello, 1921'])
+    cd_noms, report = resolve_taxon_names(names, name_index)
+    assert cd_noms.tolist() == [1, 2]
+    assert set(report['statut']) == {'exact'}
+
+
+def test_fuzzy_matches_single_typos():
+    name_index = build_name_index(make_taxref())
+    ngram_index = build_ngram_index(name_index)
+    names = pd.Series(['erica cinera', 'parus majr', 'Canis lupus italicu'])
+    cd_noms, report = resolve_taxon_names(names, name_index, ngram_index)
+    assert cd_noms.tolist() == [3, 4, 2]
+    assert set(report['statut']) == {'approche'}
+
+
+def test_fuzzy_does_not_confuse_species_and_subspecies():
+    taxref = make_taxref()
+    name_index = build_name_index(taxref[taxref['cd_nom'] != 1])
+    ngram_index = build_ngram_index(name_index)
+    cd_noms, report = resolve_taxon_names(pd.Series(['Canis lupus']), name_index, ngram_index)
+    assert cd_noms.isna().all()
+    assert report['statut'].tolist() == ['non_resolu']
+
+
+def test_get_taxsup_keeps_only_requested_columns():
+    taxref = pd.DataFrame({'cd_nom': [10, 20], 'cd_ref': [10, 20], 'cd_taxsup': [20, 0], 'id_rang': ['ES', 'GN']})
+    obs = pd.DataFrame({'cd_ref': [10], 'cd_taxsup': [20], 'id_rang': ['ES'], 'event_key': [7], 'autre': ['x']})
+    obs_sup = get_taxsup(obs, taxref, keep_columns=('event_key',))
+    assert 'event_key' in obs_sup.columns and 'autre' not in obs_sup.columns
+    assert obs_sup[['cd_ref', 'id_rang', 'event_key']].iloc[0].tolist() == [20, 'GN', 7]
+
+
+def test_resolve_to_rank_marks_observations_outside_the_clade():
+    taxrank = pd.DataFrame({'id_rang': ['KD', 'GN', 'ES'], 'tri_rang': [20, 180, 220]})
+    taxref = pd.DataFrame({'cd_nom': [1, 2, 3, 4, 5], 'cd_ref': [1, 2, 3, 4, 5], 'cd_taxsup': [0, 1, 2, 1, 4],
+                           'id_rang': ['KD', 'GN', 'ES', 'GN', 'ES'], 'lb_nom': list('abcde')})
+    nested_set = build_nested_set_index(taxref)
+    result = resolve_to_rank(pd.Series([3, 5, 99]), taxref, taxrank, 220, clade_roots=[2], nested_set=nested_set)
+    assert result['statut'].tolist() == ['compte', 'hors_clade', 'non_trouve']
+    result = resolve_to_rank(pd.Series([3, 5]), taxref, taxrank, 220, clade_roots=[2], clade_exclude=True,
+                             nested_set=nested_set)
+    assert result['statut'].tolist() == ['hors_clade', 'compte']
+
+
+def make_case_taxref():
+    return pd.DataFrame({
+        'cd_nom': [1, 2, 3, 4, 5, 6],
+        'cd_ref': [1, 2, 3, 4, 5, 6],
+        'lb_nom': ['Canis', 'Canis lupus', 'Acer campestre', 'Acer campestre subsp. leiocarpum',
+                   'Quercus robur', 'Quercus robur subsp. robur'],
+        'nom_complet': ['Canis Linnaeus, 1758', 'Canis lupus Linnaeus, 1758', 'Acer campestre L.',
+                        'Acer campestre L. subsp. leiocarpum (Opiz) Pax', 'Quercus robur L.',
+                        'Quercus robur L. subsp. robur'],
+    })
+
+
+def test_epithet_case_is_normalized():
+    name_index = build_name_index(make_case_taxref())
+    cd_noms, report = resolve_taxon_names(pd.Series(['Canis Lupus', '  canis   LUPUS  ']), name_index)
+    assert cd_noms.tolist() == [2, 2]
+    assert set(report['statut']) == {'exact'}
+
+
+def test_unknown_capitalized_epithet_is_not_resolved_to_the_genus():
+    taxref = make_case_taxref()
+    name_index = build_name_index(taxref[taxref['cd_nom'] != 2])
+    cd_noms, report = resolve_taxon_names(pd.Series(['Canis Lupus']), name_index)
+    assert cd_noms.isna().all()
+    assert report['statut'].tolist() == ['non_resolu']
+
+
+def test_infraspecific_rank_after_author_citation():
+    assert normalize_taxon_names(pd.Series(['Acer campestre L. subsp. leiocarpum (Opiz) Pax',
+                                            'Quercus robur L. subsp. robur'])).tolist() == [
+        'acer campestre subsp. leiocarpum', 'quercus robur subsp. robur']
+    name_index = build_name_index(make_case_taxref())
+    assert not name_index['ambiguous'].any()
+    names = pd.Series(['Acer campestre L. subsp. leiocarpum (Opiz) Pax', 'Quercus robur', 'Quercus robur L.'])
+    cd_noms, report = resolve_taxon_names(names, name_index)
+    assert cd_noms.tolist() == [4, 5, 5]
+    assert set(report['statut']) == {'exact'}
+
+
+def test_unknown_subspecies_falls_back_to_its_species():
+    name_index = build_name_index(make_case_taxref())
+    cd_noms, report = resolve_taxon_names(pd.Series(['Canis lupus italicus Altobello, 1921']), name_index)
+    assert cd_noms.tolist() == [2]
+    assert report['statut'].tolist() == ['approche']
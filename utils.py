@@ -1,6 +1,9 @@
 """
 Module utilitaire pour le traitement des données taxonomiques de TAXREF.
 """
+import re
+
+import numpy as np
 import pandas as pd
 
 def get_cd_ref_from_cd_nom(obs_df: pd.DataFrame, cd_nom_column: str, taxon_table: pd.DataFrame) -> pd.DataFrame:
@@ -34,28 +37,589 @@ def get_tri_rang(obs_df: pd.DataFrame, taxrank_table: pd.DataFrame) -> pd.DataFr
     return obs_df.merge(taxrank_table[['id_rang','tri_rang']], 
                        left_on='id_rang', right_on='id_rang', how='left')
 
-def get_taxsup(obs_df: pd.DataFrame, taxon_table: pd.DataFrame) -> pd.DataFrame:
+def get_taxsup(obs_df: pd.DataFrame, taxon_table: pd.DataFrame, keep_columns=()) -> pd.DataFrame:
     """
     Remonte d'un niveau dans la hiérarchie taxonomique.
     
     Args:
         obs_df: DataFrame avec cd_taxsup
         taxon_table: Table TAXREF
+        keep_columns: Colonnes de obs_df à conserver telles quelles (clé d'événement...)
     """
+    extra_columns = list(keep_columns)
     obs_sup = obs_df.merge(taxon_table[['cd_ref', 'cd_nom', 'cd_taxsup', 'id_rang']], 
                           left_on='cd_taxsup', right_on='cd_nom', 
                           how='left', suffixes=('','_sup'))
     
     if 'cd_nom' in obs_df.columns:
-        obs_sup = obs_sup[['cd_ref_sup', 'cd_nom_sup','cd_taxsup_sup','id_rang_sup']].rename(
+        obs_sup = obs_sup[['cd_ref_sup', 'cd_nom_sup','cd_taxsup_sup','id_rang_sup'] + extra_columns].rename(
             columns={'cd_ref_sup':'cd_ref',
                     'cd_nom_sup':'cd_nom',
                     'cd_taxsup_sup':'cd_taxsup', 
                     'id_rang_sup':'id_rang'})
     else:
-        obs_sup = obs_sup[['cd_ref_sup', 'cd_nom','cd_taxsup_sup','id_rang_sup']].rename(
+        obs_sup = obs_sup[['cd_ref_sup', 'cd_nom','cd_taxsup_sup','id_rang_sup'] + extra_columns].rename(
             columns={'cd_ref_sup':'cd_ref',
                     'cd_taxsup_sup':'cd_taxsup', 
                     'id_rang_sup':'id_rang'})
 
-    return get_cd_ref_from_cd_nom(obs_sup.drop(columns='cd_ref'), 'cd_nom', taxon_table)
\ No newline at end of file
+    return get_cd_ref_from_cd_nom(obs_sup.drop(columns='cd_ref'), 'cd_nom', taxon_table)
+
+# Marqueurs de rang infraspécifique conservés dans les noms scientifiques normalisés
+INFRA_RANK_MARKERS = {'ssp.': 'subsp.', 'subsp.': 'subsp.', 'var.': 'var.', 'subvar.': 'subvar.',
+                      'f.': 'f.', 'fo.': 'f.', 'forma': 'f.'}
+
+# Particules d'auteurs, à ne pas confondre avec des épithètes ("de Candolle", "von Martens"...)
+AUTHOR_PARTICLES = ('de', 'del', 'della', 'der', 'den', 'des', 'di', 'da', 'dos', 'du', 'la', 'le',
+                    'van', 'von', 'ex', 'in', 'et')
+
+# Mot d'une citation d'auteur : ponctuation, parenthèse, chiffre ou "&" ("L.", "(Opiz)", "1758", "Linnaeus,")
+_AUTHOR_TOKEN = re.compile(r"[.,;:()\[\]&'\"\d]")
+_EPITHET_TOKEN = re.compile(r"×?[A-Za-z][A-Za-z\-]*")
+
+
+def _is_author_token(token: str) -> bool:
+    return bool(_AUTHOR_TOKEN.search(token)) or token.lower() in AUTHOR_PARTICLES
+
+
+def _is_epithet_token(token: str, lowercase: bool = False) -> bool:
+    return (bool(_EPITHET_TOKEN.fullmatch(token)) and token.lower() not in AUTHOR_PARTICLES
+            and not (lowercase and token.lstrip('×')[0].isupper()))
+
+
+def _canonical_name(name: str) -> str:
+    """
+    Partie canonique d'un nom dont les accents, espaces et marqueurs ont été uniformisés.
+
+    Le genre et l'épithète spécifique sont retenus quelle que soit leur casse ; les épithètes suivantes
+    s'arrêtent au premier mot d'auteur (ponctuation, chiffre, particule, ou majuscule comme dans
+    "Canis lupus Linnaeus"). Les rangs infraspécifiques cités après un auteur
+    ("Acer campestre L. subsp. leiocarpum (Opiz) Pax") sont ajoutés à la suite.
+    """
+    tokens = name.split(' ')
+    kept = []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token in INFRA_RANK_MARKERS.values() and kept:
+            if i + 1 < len(tokens) and _is_epithet_token(tokens[i + 1], lowercase=True):
+                kept += [token, tokens[i + 1].lower()]
+                i += 2
+                continue
+            break
+        if (_is_author_token(token) or not _is_epithet_token(token)
+                or (len(kept) >= 2 and token[0].isupper())):
+            break
+        kept.append(token.lower())
+        i += 1
+    if not kept:
+        return name.lower()
+    for marker, epithet in zip(tokens[i:], tokens[i + 1:]):
+        if marker in INFRA_RANK_MARKERS.values() and _is_epithet_token(epithet, lowercase=True):
+            kept += [marker, epithet.lower()]
+    return ' '.join(kept)
+
+
+def normalize_taxon_names(names: pd.Series) -> pd.Series:
+    """
+    Normalise des noms scientifiques pour la correspondance avec TAXREF.
+
+    Supprime les accents, les espaces superflus et les auteurs, uniformise les marqueurs
+    infraspécifiques et le signe hybride puis passe en minuscules. Les remplacements sont vectorisés
+    sur la Series, l'extraction de la partie canonique est faite une fois par nom distinct.
+
+    Args:
+        names: Series de noms scientifiques
+    """
+    normalized = (names.astype(str)
+                  .str.normalize('NFKD')
+                  .str.replace('[\u0300-\u036f]', '', regex=True)
+                  .str.replace(r'\s+', ' ', regex=True)
+                  .str.strip())
+    # Noms entièrement en majuscules : on rétablit la casse usuelle pour distinguer épithètes et auteurs
+    normalized = normalized.where(~normalized.str.isupper(), normalized.str.capitalize())
+    for marker, replacement in INFRA_RANK_MARKERS.items():
+        normalized = normalized.str.replace(f" {marker} ", f" {replacement} ", regex=False)
+    # Signe hybride isolé ("Ophrys x arachnitiformis", "x Ophrys") accolé au nom qui suit
+    normalized = (normalized.str.replace(r'^[x×] ([A-Za-z])', r'×\1', regex=True)
+                  .str.replace(r' [x×] ([A-Za-z])', r' ×\1', regex=True))
+
+    codes, uniques = pd.factorize(normalized)
+    canonical = np.array([_canonical_name(name) for name in uniques], dtype=object)
+    return pd.Series(canonical[codes], index=names.index, dtype=object)
+
+
+def build_name_index(taxon_table: pd.DataFrame, name_columns=('lb_nom', 'nom_complet')) -> pd.DataFrame:
+    """
+    Construit l'index de hachage des noms TAXREF normalisés.
+
+    Un nom normalisé qui désigne plusieurs cd_ref différents est marqué ambigu. Sinon il est
+    associé au cd_nom du taxon de référence lorsqu'il en fait partie.
+
+    Args:
+        taxon_table: Table TAXREF
+        name_columns: Colonnes de noms à indexer (celles absentes de la table sont ignorées)
+
+    Returns:
+        DataFrame indexé par nom normalisé avec les colonnes cd_nom et ambiguous
+    """
+    columns = [col for col in name_columns if col in taxon_table.columns]
+    if not columns:
+        raise Exception(f"Aucune colonne de noms ({', '.join(name_columns)}) dans la table TAXREF")
+
+    names = pd.concat([
+        pd.DataFrame({'nom': taxon_table[col], 'cd_nom': taxon_table['cd_nom'], 'cd_ref': taxon_table['cd_ref']})
+        for col in columns
+    ]).dropna(subset=['nom'])
+    names = names.drop_duplicates(['nom', 'cd_nom'])
+    names['nom_norm'] = normalize_taxon_names(names['nom'])
+
+    ambiguous = names.groupby('nom_norm')['cd_ref'].nunique() > 1
+    names['is_ref'] = names['cd_nom'] == names['cd_ref']
+    index = (names.sort_values(['nom_norm', 'is_ref', 'cd_nom'], ascending=[True, False, True])
+             .drop_duplicates('nom_norm')
+             .set_index('nom_norm')[['cd_nom']])
+    index['ambiguous'] = ambiguous.reindex(index.index).to_numpy()
+    return index
+
+
+def _trigrams(name: str) -> list:
+    """Trigrammes d'un nom normalisé, complété par des espaces aux extrémités."""
+    padded = f"  {name} "
+    return [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+
+def build_ngram_index(name_index: pd.DataFrame) -> dict:
+    """
+    Construit l'index de trigrammes des noms de l'index de hachage, pour la correspondance approchée.
+
+    Args:
+        name_index: Index des noms construit par build_name_index
+
+    Returns:
+        Dictionnaire avec les listes de postings triées par trigramme :
+        'trigrams' (pd.Index des trigrammes), 'offsets', 'name_ids' et 'sizes' (nombre de trigrammes distincts par nom)
+    """
+    grams = [list(dict.fromkeys(_trigrams(name))) for name in name_index.index]
+    sizes = np.array([len(g) for g in grams], dtype=np.int64)
+    name_ids = np.repeat(np.arange(len(grams)), sizes)
+    codes, trigrams = pd.factorize(pd.Series([t for g in grams for t in g], dtype=object))
+
+    order = np.argsort(codes, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(trigrams)))])
+    return {'trigrams': pd.Index(trigrams), 'offsets': offsets, 'name_ids': name_ids[order], 'sizes': sizes}
+
+
+def fuzzy_match_names(names, name_index: pd.DataFrame, ngram_index: dict, min_similarity: float = None,
+                      max_edits: int = None) -> pd.Series:
+    """
+    Recherche pour chaque nom normalisé le nom indexé le plus proche (similarité de Jaccard des trigrammes).
+
+    Une faute de frappe modifie jusqu'à trois trigrammes : par défaut, le seuil de similarité est celui
+    de max_edits fautes sur un nom de cette longueur, (n - 3k) / (n + 3k) pour n trigrammes et k fautes.
+    Les candidats dont la longueur diffère de plus de max_edits caractères sont écartés, pour ne pas
+    associer une espèce à l'une de ses sous-espèces.
+
+    Args:
+        names: Noms normalisés à rechercher
+        name_index: Index des noms construit par build_name_index
+        ngram_index: Index de trigrammes construit par build_ngram_index
+        min_similarity: Similarité minimale pour accepter une correspondance (par défaut, dépend de la longueur)
+        max_edits: Nombre de fautes toléré (par défaut, 1 + une par tranche de 15 caractères)
+
+    Returns:
+        Series indexée par les noms recherchés contenant le nom indexé retenu (NaN si aucun)
+    """
+    matches = {}
+    for name in names:
+        grams = pd.unique(pd.Series(_trigrams(name), dtype=object))
+        codes = ngram_index['trigrams'].get_indexer(grams)
+        codes = codes[codes >= 0]
+        if len(codes) == 0:
+            continue
+        edits = max_edits if max_edits is not None else 1 + len(name) // 15
+        threshold = min_similarity if min_similarity is not None else (len(grams) - 3 * edits) / (len(grams) + 3 * edits)
+
+        starts, ends = ngram_index['offsets'][codes], ngram_index['offsets'][codes + 1]
+        candidates = np.concatenate([ngram_index['name_ids'][s:e] for s, e in zip(starts, ends)])
+        candidate_ids, shared = np.unique(candidates, return_counts=True)
+        sizes = ngram_index['sizes'][candidate_ids]
+        scores = shared / (len(grams) + sizes - shared)
+        scores[np.abs(sizes - len(grams)) > edits] = 0
+        best = np.argmax(scores)
+        if scores[best] > 0 and scores[best] >= threshold:
+            matches[name] = name_index.index[candidate_ids[best]]
+    return pd.Series(matches, index=pd.Index(names), dtype=object)
+
+
+def _indexed_prefix(name: str, name_index: pd.DataFrame):
+    """Plus long préfixe d'au moins deux mots d'un nom normalisé présent dans l'index (None si aucun)."""
+    tokens = name.split(' ')
+    for size in range(len(tokens) - 1, 1, -1):
+        prefix = ' '.join(tokens[:size])
+        if prefix in name_index.index:
+            return prefix
+    return None
+
+
+def resolve_taxon_names(names: pd.Series, name_index: pd.DataFrame, ngram_index: dict = None,
+                        min_similarity: float = None):
+    """
+    Associe un cd_nom à chaque nom scientifique en ne traitant que les valeurs distinctes.
+
+    Un nom est exact si sa partie canonique (sans les auteurs) est dans l'index. Sinon, après la
+    correspondance approchée, un nom dont seul un préfixe d'au moins deux mots est connu (sous-espèce
+    absente de TAXREF...) est rattaché à ce préfixe avec le statut approché ; un genre seul suivi d'un
+    mot inconnu ("Canis Lupus" sans Canis lupus dans l'index) reste non résolu.
+
+    Args:
+        names: Series de noms scientifiques (une valeur par observation)
+        name_index: Index des noms construit par build_name_index
+        ngram_index: Index de trigrammes optionnel pour la correspondance approchée des noms non résolus
+        min_similarity: Similarité minimale de la correspondance approchée (par défaut, dépend de la longueur du nom)
+
+    Returns:
+        Tuple (cd_noms, report) : Series des cd_nom alignée sur names (NaN si non résolu ou ambigu)
+        et DataFrame des noms distincts avec leur nombre d'observations, le nom retenu, le cd_nom
+        et le statut ('exact', 'approche', 'ambigu', 'non_resolu')
+    """
+    codes, uniques = pd.factorize(names)
+    distinct = pd.Series(uniques, dtype=object)
+    report = pd.DataFrame({
+        'nom': distinct,
+        'nb_observations': np.bincount(codes[codes >= 0], minlength=len(distinct)),
+        'nom_norm': normalize_taxon_names(distinct),
+    })
+    report['nom_index'] = report['nom_norm'].where(report['nom_norm'].isin(name_index.index))
+    report['statut'] = np.where(report['nom_index'].notna(), 'exact', 'non_resolu')
+
+    if ngram_index is not None:
+        unresolved = report['nom_index'].isna()
+        fuzzy = fuzzy_match_names(report.loc[unresolved, 'nom_norm'].unique(), name_index, ngram_index, min_similarity)
+        report.loc[unresolved, 'nom_index'] = report.loc[unresolved, 'nom_norm'].map(fuzzy)
+        report.loc[unresolved & report['nom_index'].notna(), 'statut'] = 'approche'
+
+    unresolved = report['nom_index'].isna()
+    prefixes = report.loc[unresolved, 'nom_norm'].map(lambda name: _indexed_prefix(name, name_index))
+    report.loc[unresolved, 'nom_index'] = prefixes
+    report.loc[unresolved & report['nom_index'].notna(), 'statut'] = 'approche'
+
+    matched = name_index.reindex(report['nom_index'])
+    ambiguous = matched['ambiguous'].fillna(False).astype(bool).to_numpy()
+    report['cd_nom'] = matched['cd_nom'].to_numpy()
+    report.loc[ambiguous, 'statut'] = 'ambigu'
+    report.loc[ambiguous, 'cd_nom'] = np.nan
+
+    cd_noms = pd.Series(np.where(codes >= 0, report['cd_nom'].to_numpy()[codes], np.nan), index=names.index)
+    return cd_noms, report.drop(columns='nom_norm')
+
+
+def build_nested_set_index(taxon_table: pd.DataFrame) -> pd.DataFrame:
+    """
+    Numérote l'arbre taxonomique (cd_taxsup) selon un parcours en profondeur (ensembles imbriqués).
+
+    Chaque taxon de référence reçoit un intervalle [left, right] contenant exactement ceux
+    de ses descendants : "X descend de Y" équivaut à left[Y] <= left[X] <= right[Y].
+    Le calcul est vectorisé niveau par niveau (profondeurs, tailles des sous-arbres puis numérotation).
+
+    Args:
+        taxon_table: Table TAXREF
+
+    Returns:
+        DataFrame indexé par cd_ref avec les colonnes parent (cd_ref du taxon supérieur, -1 pour une racine),
+        depth, size (taille du sous-arbre), left et right
+    """
+    refs = taxon_table.loc[taxon_table['cd_nom'] == taxon_table['cd_ref'], ['cd_ref', 'cd_taxsup']]
+    refs = refs.drop_duplicates('cd_ref').sort_values('cd_ref')
+    nodes = refs['cd_ref'].to_numpy(dtype=np.int64)
+    nb_nodes = len(nodes)
+
+    # Le taxon supérieur peut être un synonyme : on le ramène à son cd_ref
+    nom_to_ref = pd.Series(taxon_table['cd_ref'].to_numpy(), index=taxon_table['cd_nom'].to_numpy())
+    nom_to_ref = nom_to_ref[~nom_to_ref.index.duplicated()]
+    parent_ref = refs['cd_taxsup'].map(nom_to_ref).to_numpy(dtype=float)
+    parent = pd.Index(nodes).get_indexer(np.nan_to_num(parent_ref, nan=-1).astype(np.int64))
+    parent[parent == np.arange(nb_nodes)] = -1
+
+    # Enfants regroupés par parent (format CSR), triés par cd_ref au sein d'un même parent
+    has_parent = parent >= 0
+    children = np.flatnonzero(has_parent)
+    children = children[np.argsort(parent[children], kind='stable')]
+    child_ptr = np.concatenate([[0], np.cumsum(np.bincount(parent[has_parent], minlength=nb_nodes))])
+
+    def children_of(level):
+        starts, lengths = child_ptr[level], child_ptr[level + 1] - child_ptr[level]
+        offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+        return children[offsets + np.arange(lengths.sum())]
+
+    # Parcours en largeur depuis les racines ; les noeuds pris dans un cycle ne sont jamais atteints
+    depth = np.full(nb_nodes, -1, dtype=np.int64)
+    levels = [np.flatnonzero(~has_parent)]
+    while len(levels[-1]) > 0:
+        depth[levels[-1]] = len(levels) - 1
+        levels.append(children_of(levels[-1]))
+    levels.pop()
+    if (depth < 0).any():
+        raise Exception(f"{(depth < 0).sum()} taxons de TAXREF ne sont pas rattachés à une racine (cycle dans cd_taxsup)")
+
+    # Tailles des sous-arbres, des feuilles vers les racines
+    size = np.ones(nb_nodes, dtype=np.int64)
+    for level in reversed(levels[1:]):
+        np.add.at(size, parent[level], size[level])
+
+    # Numérotation préfixe : un enfant commence après son parent et ses frères précédents
+    left = np.zeros(nb_nodes, dtype=np.int64)
+    roots = levels[0]
+    left[roots] = np.concatenate([[0], np.cumsum(size[roots])[:-1]])
+    for level in levels[:-1]:
+        kids = children_of(level)
+        if len(kids) == 0:
+            continue
+        kid_sizes = size[kids]
+        kid_group = np.repeat(np.arange(len(level)), child_ptr[level + 1] - child_ptr[level])
+        group_sizes = np.bincount(kid_group, weights=kid_sizes, minlength=len(level)).astype(np.int64)
+        cumulative = np.cumsum(kid_sizes) - kid_sizes
+        group_start = (np.cumsum(group_sizes) - group_sizes)[kid_group]
+        left[kids] = left[parent[kids]] + 1 + cumulative - group_start
+
+    return pd.DataFrame({
+        'parent': np.where(parent >= 0, nodes[np.maximum(parent, 0)], -1),
+        'depth': depth,
+        'size': size,
+        'left': left,
+        'right': left + size - 1,
+    }, index=pd.Index(nodes, name='cd_ref'))
+
+
+def clade_mask(cd_refs: pd.Series, clade_roots, nested_set: pd.DataFrame) -> np.ndarray:
+    """
+    Indique pour chaque cd_ref s'il appartient à l'un des clades donnés (racines incluses).
+
+    Les intervalles des racines sont fusionnés puis chaque observation est localisée par
+    recherche dichotomique : le filtre est un unique masque vectorisé.
+
+    Args:
+        cd_refs: Series des cd_ref des observations
+        clade_roots: cd_ref des racines des clades
+        nested_set: Index construit par build_nested_set_index
+    """
+    roots = nested_set.reindex(pd.Index(clade_roots).unique()).dropna()
+    if roots.empty:
+        return np.zeros(len(cd_refs), dtype=bool)
+
+    # Intervalles disjoints : on ne garde que les racines non incluses dans une autre
+    roots = roots.sort_values(['left', 'right'], ascending=[True, False])
+    outermost = roots['right'].to_numpy() > np.concatenate([[-1], np.maximum.accumulate(roots['right'].to_numpy())[:-1]])
+    starts = roots['left'].to_numpy()[outermost]
+    ends = roots['right'].to_numpy()[outermost]
+
+    positions = nested_set['left'].reindex(cd_refs.to_numpy()).to_numpy(dtype=float)
+    found = ~np.isnan(positions)
+    slot = np.searchsorted(starts, np.nan_to_num(positions, nan=-1), side='right') - 1
+    return found & (slot >= 0) & (np.nan_to_num(positions, nan=-1) <= ends[np.maximum(slot, 0)])
+
+
+def event_keys(obs_df: pd.DataFrame, event_columns) -> pd.Series:
+    """
+    Identifiant exact de l'événement (combinaison des valeurs des colonnes d'événement) de chaque observation.
+
+    Args:
+        obs_df: DataFrame des observations
+        event_columns: Colonnes définissant un événement (date, lieu, observateur, maille...)
+    """
+    return obs_df.groupby(list(event_columns), sort=False, dropna=False).ngroup().astype(np.int64)
+
+
+def event_hashes(obs_df: pd.DataFrame, event_columns) -> pd.Series:
+    """
+    Hachage 64 bits vectorisé de la combinaison des valeurs des colonnes d'événement, pour le comptage approché.
+
+    Args:
+        obs_df: DataFrame des observations
+        event_columns: Colonnes définissant un événement
+    """
+    return pd.util.hash_pandas_object(obs_df[list(event_columns)], index=False)
+
+
+def _leading_zeros64(values: np.ndarray) -> np.ndarray:
+    """Nombre de zéros en tête de chaque entier non signé 64 bits (recherche dichotomique vectorisée)."""
+    values = values.astype(np.uint64)
+    zeros = np.zeros(len(values), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        empty_top = (values >> np.uint64(64 - shift)) == 0
+        zeros += empty_top * shift
+        values = np.where(empty_top, values << np.uint64(shift), values)
+    return np.where(values == 0, 64, zeros)
+
+
+def hyperloglog_registers(cd_refs: pd.Series, hashes: pd.Series, precision: int = 12) -> pd.DataFrame:
+    """
+    Registres HyperLogLog (creux) par taxon : pour chaque couple (cd_ref, registre), le rang maximal observé.
+
+    Les registres de plusieurs appels se combinent par concaténation puis maximum par (cd_ref, registre),
+    la mémoire reste donc bornée par le nombre de taxons × 2^precision.
+
+    Args:
+        cd_refs: Series des cd_ref des observations comptées
+        hashes: Hachages 64 bits des événements correspondants
+        precision: Nombre de bits du hachage servant à choisir le registre
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    registers = hashes >> np.uint64(64 - precision)
+    remaining = (hashes << np.uint64(precision)) | np.uint64(1 << (precision - 1))
+    rho = _leading_zeros64(remaining) + 1
+    return (pd.DataFrame({'cd_ref': np.asarray(cd_refs), 'register': registers.astype(np.int64), 'rho': rho})
+            .groupby(['cd_ref', 'register'], as_index=False)['rho'].max())
+
+
+def hyperloglog_estimate(registers: pd.DataFrame, precision: int = 12) -> pd.Series:
+    """
+    Estime le nombre d'événements distincts par taxon à partir des registres HyperLogLog.
+
+    Args:
+        registers: Registres construits (et combinés) avec hyperloglog_registers
+        precision: Précision utilisée pour construire les registres
+
+    Returns:
+        Series des effectifs estimés indexée par cd_ref
+    """
+    nb_registers = 1 << precision
+    alpha = 0.7213 / (1 + 1.079 / nb_registers)
+    registers = registers.groupby(['cd_ref', 'register'])['rho'].max().reset_index()
+    registers['inverse'] = np.power(2.0, -registers['rho'].to_numpy(dtype=float))
+
+    grouped = registers.groupby('cd_ref')
+    filled = grouped.size()
+    # Les registres absents valent 0 et contribuent chacun 2^0 = 1 à la somme harmonique
+    harmonic = grouped['inverse'].sum() + (nb_registers - filled)
+    estimate = alpha * nb_registers ** 2 / harmonic
+
+    # Correction pour les petits effectifs (comptage linéaire sur les registres vides)
+    empty = nb_registers - filled
+    linear = nb_registers * np.log(nb_registers / empty.where(empty > 0))
+    estimate = estimate.where(~((estimate <= 2.5 * nb_registers) & (empty > 0)), linear)
+    return estimate.round().astype(np.int64).rename('count')
+
+
+def resolve_to_rank(cd_noms, taxon_table: pd.DataFrame, taxrank_table: pd.DataFrame, wanted_rank: int,
+                    important_taxons=(), force_ascent: bool = False, clade_roots=(), clade_exclude: bool = False,
+                    nested_set: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    Détermine, pour chaque cd_nom distinct, le taxon sous lequel ses observations sont comptées.
+
+    Reprend la remontée hiérarchique du comptage sur les seules valeurs distinctes : le résultat
+    peut ensuite être reporté sur chaque observation par simple jointure.
+
+    Args:
+        cd_noms: cd_nom des observations (les doublons sont ignorés)
+        taxon_table: Table TAXREF
+        taxrank_table: Table des rangs taxonomiques
+        wanted_rank: tri_rang du rang demandé
+        important_taxons: cd_ref des taxons importants comptés même sous le rang demandé
+        force_ascent: Si vrai, les observations de taxons importants sont aussi remontées au rang demandé
+            (le taxon retenu est alors celui du rang demandé)
+        clade_roots: cd_ref des clades du filtre taxonomique (aucun filtre si vide)
+        clade_exclude: Si vrai, les clades sont exclus au lieu d'être seuls conservés
+        nested_set: Index construit par build_nested_set_index (requis si clade_roots est renseigné)
+
+    Returns:
+        DataFrame indexé par cd_nom avec les colonnes cd_ref, nom, id_rang (du taxon retenu) et statut
+        parmi 'compte', 'imprecis', 'sans_correspondance', 'non_trouve', 'hors_clade'
+    """
+    distinct = pd.Index(pd.unique(np.asarray(cd_noms, dtype=np.int64)), name='cd_nom')
+    result = pd.DataFrame({'cd_ref': np.nan, 'statut': 'imprecis'}, index=distinct)
+    result.loc[~distinct.isin(taxon_table['cd_nom']), 'statut'] = 'non_trouve'
+
+    # Les cd_nom absents de TAXREF ne peuvent pas être remontés
+    known = distinct[distinct.isin(taxon_table['cd_nom'])].to_numpy()
+    obs = pd.DataFrame({'cd_nom_obs': known, '_cd_nom': known})
+    obs_ref = get_tri_rang(get_cd_ref_from_cd_nom(obs, '_cd_nom', taxon_table), taxrank_table)
+    # Même filtre taxonomique que le comptage, sur le taxon observé
+    if len(clade_roots):
+        in_clade = clade_mask(obs_ref['cd_ref'], clade_roots, nested_set)
+        outside = in_clade if clade_exclude else ~in_clade
+        result.loc[obs_ref.loc[outside, 'cd_nom_obs'].to_numpy(), 'statut'] = 'hors_clade'
+        obs_ref = obs_ref[~outside]
+    obs_ref = obs_ref[obs_ref['tri_rang'] >= wanted_rank]
+
+    while len(obs_ref) > 0:
+        no_matching_rank = obs_ref['tri_rang'] < wanted_rank
+        not_counted = result.loc[obs_ref.loc[no_matching_rank, 'cd_nom_obs'], 'statut'] != 'compte'
+        result.loc[not_counted.index[not_counted.to_numpy()], 'statut'] = 'sans_correspondance'
+        obs_ref = obs_ref[~no_matching_rank]
+
+        condition_rank = obs_ref['tri_rang'] == wanted_rank
+        condition_taxon = obs_ref['cd_ref'].isin(important_taxons)
+        counted = obs_ref[condition_rank | condition_taxon]
+        result.loc[counted['cd_nom_obs'].to_numpy(), 'cd_ref'] = counted['cd_ref'].to_numpy()
+        result.loc[counted['cd_nom_obs'].to_numpy(), 'statut'] = 'compte'
+
+        if not force_ascent:
+            obs_ref = obs_ref[~(condition_rank | condition_taxon)]
+        else:
+            obs_ref = obs_ref[~condition_rank]
+        obs_ref = get_tri_rang(get_taxsup(obs_ref, taxon_table, keep_columns=('cd_nom_obs',)), taxrank_table)
+
+    name_column = 'nom_complet' if 'nom_complet' in taxon_table.columns else 'lb_nom'
+    refs = taxon_table[taxon_table['cd_nom'] == taxon_table['cd_ref']].drop_duplicates('cd_ref').set_index('cd_ref')
+    result['nom'] = refs[name_column].reindex(result['cd_ref']).to_numpy() if name_column in refs.columns else None
+    result['id_rang'] = refs['id_rang'].reindex(result['cd_ref']).to_numpy()
+    result['cd_ref'] = result['cd_ref'].astype('Int64')
+    return result[['cd_ref', 'nom', 'id_rang', 'statut']]
+
+
+def taxonomy_rollup(direct_counts: pd.Series, nested_set: pd.DataFrame, taxon_table: pd.DataFrame,
+                    taxrank_table: pd.DataFrame) -> pd.DataFrame:
+    """
+    Construit le sous-arbre induit par les taxons observés et cumule les effectifs de chaque sous-arbre.
+
+    Le sous-arbre contient les taxons observés et tous leurs ancêtres. Grâce à la numérotation en
+    ensembles imbriqués, l'effectif cumulé d'un noeud est la somme des effectifs directs des noeuds
+    dont left est compris dans [left, right] : une somme préfixe sur les noeuds triés par left
+    suffit, en une seule passe vectorisée.
+
+    Args:
+        direct_counts: Series des effectifs directs indexée par cd_ref
+        nested_set: Index construit par build_nested_set_index
+        taxon_table: Table TAXREF
+        taxrank_table: Table des rangs taxonomiques
+
+    Returns:
+        DataFrame (cd_ref, cd_parent, depth, id_rang, tri_rang, count_direct, count_cumul)
+        trié dans l'ordre du parcours en profondeur (un parent précède toujours ses enfants)
+    """
+    direct_counts = direct_counts.groupby(level=0).sum()
+    positions = nested_set.index.get_indexer(direct_counts.index)
+    found = positions >= 0
+    parent_positions = nested_set.index.get_indexer(nested_set['parent'].to_numpy())
+
+    # Ancêtres des taxons observés, niveau par niveau
+    in_tree = np.zeros(len(nested_set), dtype=bool)
+    frontier = np.unique(positions[found])
+    in_tree[frontier] = True
+    while len(frontier) > 0:
+        parents = np.unique(parent_positions[frontier])
+        parents = parents[(parents >= 0)]
+        frontier = parents[~in_tree[parents]]
+        in_tree[frontier] = True
+
+    tree = nested_set[in_tree].sort_values('left')
+    direct = np.zeros(len(nested_set), dtype=np.int64)
+    np.add.at(direct, positions[found], direct_counts.to_numpy(dtype=np.int64)[found])
+    tree_direct = direct[in_tree][np.argsort(nested_set['left'].to_numpy()[in_tree])]
+
+    prefix = np.concatenate([[0], np.cumsum(tree_direct)])
+    lefts = tree['left'].to_numpy()
+    start = np.searchsorted(lefts, lefts, side='left')
+    end = np.searchsorted(lefts, tree['right'].to_numpy(), side='right')
+
+    rollup = pd.DataFrame({
+        'cd_ref': tree.index.to_numpy(),
+        'cd_parent': tree['parent'].to_numpy(),
+        'depth': tree['depth'].to_numpy(),
+        'count_direct': tree_direct,
+        'count_cumul': prefix[end] - prefix[start],
+    })
+    ranks = taxon_table[taxon_table['cd_nom'] == taxon_table['cd_ref']].drop_duplicates('cd_ref')[['cd_ref', 'id_rang']]
+    rollup = get_tri_rang(rollup.merge(ranks, on='cd_ref', how='left'), taxrank_table)
+    return rollup[['cd_ref', 'cd_parent', 'depth', 'id_rang', 'tri_rang', 'count_direct', 'count_cumul']]